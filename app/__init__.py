@@ -1,3 +1,11 @@
-from app.models import Message, MessageRecipient, User
+from app.models import (Conversation, ConversationParticipant, MailboxCounter,
+                        Message, MessageRecipient, User)
 
-all_models = [User, Message, MessageRecipient]
+all_models = [
+    User,
+    Conversation,
+    Message,
+    MessageRecipient,
+    MailboxCounter,
+    ConversationParticipant,
+]
@@ -0,0 +1,151 @@
+# Admission control for POST /messages
+#
+# A client sending large recipient lists in a loop could otherwise hold most
+# pooled connections and slow every read. Two in-process guards stand in
+# front of send_message:
+#
+#   rate limit  a token bucket per user, charged one token per recipient;
+#               an empty bucket answers 429 with Retry-After
+#   concurrency at most SEND_CONCURRENCY sends run at once. Up to
+#               SEND_QUEUE_SIZE more wait SEND_QUEUE_TIMEOUT for a slot, the
+#               rest, and those that time out, get 503 straight away and
+#               their rate-limit tokens back
+#
+# Both are per worker process, like the caches in app/cache.py.
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+from app.cache import LRUCache
+from app.metrics import send_queue_wait, sends_throttled
+
+# recipients a user may send to per second, 0 disables the rate limit
+SEND_RATE = float(os.getenv("SEND_RATE", "100"))
+# recipients a user may send to at once after being idle; larger messages
+# are admitted when the bucket is full and empty it
+SEND_BURST = float(os.getenv("SEND_BURST", "1000"))
+# users whose buckets are remembered; an evicted bucket starts full again
+SEND_RATE_USERS = int(os.getenv("SEND_RATE_USERS", "10000"))
+# sends running at once per worker, 0 disables the cap; keep it below the
+# pool size plus overflow so reads always find a connection
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "32"))
+SEND_QUEUE_TIMEOUT = float(os.getenv("SEND_QUEUE_TIMEOUT", "5"))
+
+# user id -> (tokens left, wall-clock time they were counted)
+buckets = LRUCache(SEND_RATE_USERS)
+# created by send_slots() in the loop that serves requests, not at import time
+_send_slots: asyncio.Semaphore | None = None
+_send_slots_loop: asyncio.AbstractEventLoop | None = None
+running_sends = 0
+queued_sends = 0
+
+
+# charge a user's bucket, returns 0 when admitted or the seconds until the
+# bucket holds enough tokens
+def take_tokens(user_id: str, cost: int) -> float:
+    now = time.time()
+    tokens, counted_at = buckets.get(user_id, (SEND_BURST, now))
+    tokens = min(SEND_BURST, tokens + (now - counted_at) * SEND_RATE)
+    cost = min(cost, SEND_BURST)
+    if tokens < cost:
+        return (cost - tokens) / SEND_RATE
+    _store_bucket(user_id, tokens - cost, now)
+    return 0
+
+
+# give back what take_tokens charged for a send that was then shed
+def refund_tokens(user_id: str, cost: int):
+    now = time.time()
+    bucket = buckets.get(user_id)
+    if bucket is None:
+        # evicted or already refilled, either way full
+        return
+    tokens, counted_at = bucket
+    tokens += (now - counted_at) * SEND_RATE + min(cost, SEND_BURST)
+    if tokens >= SEND_BURST:
+        buckets.pop(user_id)
+    else:
+        _store_bucket(user_id, tokens, now)
+
+
+def _store_bucket(user_id: str, tokens: float, now: float):
+    # a bucket that has refilled is the same as no bucket at all
+    buckets.set(
+        user_id, (tokens, now), expires_at=now + (SEND_BURST - tokens) / SEND_RATE
+    )
+
+
+def send_slots() -> asyncio.Semaphore:
+    """The semaphore capping concurrent sends, for the running event loop."""
+    global _send_slots, _send_slots_loop
+    loop = asyncio.get_running_loop()
+    if _send_slots is None or _send_slots_loop is not loop:
+        _send_slots = asyncio.Semaphore(max(SEND_CONCURRENCY, 1))
+        _send_slots_loop = loop
+    return _send_slots
+
+
+def _reject(status_code: int, reason: str, retry_after: float) -> HTTPException:
+    sends_throttled.inc(reason)
+    detail = "Too many messages" if status_code == 429 else "Server busy"
+    return HTTPException(
+        status_code=status_code,
+        detail=f"{detail}, retry later",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+@asynccontextmanager
+async def admit_send(user_id: str, recipients: int):
+    """Hold a send slot for the block, or raise 429/503 without running it.
+
+    A send shed for lack of capacity gets its rate-limit tokens back.
+    """
+    global queued_sends, running_sends
+    user_id = str(user_id)
+    charged = SEND_RATE > 0
+    if charged:
+        wait = take_tokens(user_id, recipients)
+        if wait:
+            raise _reject(429, "rate_limited", wait)
+    if SEND_CONCURRENCY <= 0:
+        yield
+        return
+    slots = send_slots()
+    if slots.locked():
+        if queued_sends >= SEND_QUEUE_SIZE:
+            if charged:
+                refund_tokens(user_id, recipients)
+            raise _reject(503, "queue_full", SEND_QUEUE_TIMEOUT)
+        queued_sends += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(slots.acquire(), SEND_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if charged:
+                refund_tokens(user_id, recipients)
+            raise _reject(503, "queue_timeout", SEND_QUEUE_TIMEOUT)
+        finally:
+            queued_sends -= 1
+            send_queue_wait.observe(time.perf_counter() - start)
+    else:
+        await slots.acquire()
+    running_sends += 1
+    try:
+        yield
+    finally:
+        running_sends -= 1
+        slots.release()
+
+
+def admission_stats() -> dict:
+    return {
+        "running": running_sends,
+        "queued": queued_sends,
+        "tracked_users": len(buckets),
+    }
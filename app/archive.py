@@ -0,0 +1,137 @@
+# Retention: messages older than RETENTION_DAYS move to archived_messages
+#
+# The archiver takes the oldest ARCHIVE_BATCH_SIZE messages at a time and, in
+# one short transaction per batch, copies them and their recipient rows into
+# the archive tables, lowers the unread counters of deliveries that were never
+# read, bumps the mailbox versions of everyone involved and deletes the
+# originals. Rows locked by another archiver are
+# skipped, so every worker can run it. Once a month is fully archived its
+# empty partitions are dropped. GET /messages/{id} still finds archived
+# messages; listings, search and conversations only show live ones.
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from uuid import UUID
+
+from sqlalchemy import any_, delete, func, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import AsyncSessionLocal, uuid_array
+from app.models import (ArchivedMessage, ArchivedMessageRecipient, Message,
+                        MessageRecipient)
+from app.partitions import drop_partitions
+from app.service import decrement_unread_counts
+
+logger = logging.getLogger(__name__)
+
+# days a message stays in the live tables, 0 keeps everything
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+# messages moved per transaction; broadcasts move all their recipients with
+# them, so keep it small enough for row locks to be held only briefly
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_CHECK_SECONDS = float(os.getenv("ARCHIVE_CHECK_SECONDS", "3600"))
+
+MESSAGE_COLUMNS = (
+    "id",
+    "sender_id",
+    "conversation_id",
+    "reply_to_id",
+    "subject",
+    "content",
+    "timestamp",
+)
+RECIPIENT_COLUMNS = ("id", "message_id", "recipient_id", "read", "read_at")
+
+
+# move one batch of messages sent before cutoff, in the caller's transaction;
+# returns the number of messages moved
+async def archive_batch(db: AsyncSession, cutoff: datetime, batch_size: int) -> int:
+    result = await db.execute(
+        select(Message.id, Message.timestamp, Message.sender_id)
+        .where(Message.timestamp < cutoff)
+        .order_by(Message.timestamp)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    batch = result.all()
+    if not batch:
+        return 0
+    ids = uuid_array([row.id for row in batch])
+    # the batch's time range prunes the partitions searched for its ids
+    first, last = batch[0].timestamp, batch[-1].timestamp
+
+    await db.execute(
+        insert(ArchivedMessage).from_select(
+            MESSAGE_COLUMNS,
+            select(*(Message.__table__.c[name] for name in MESSAGE_COLUMNS)).where(
+                Message.id == any_(ids), Message.timestamp.between(first, last)
+            ),
+        )
+    )
+    moved = (
+        delete(MessageRecipient)
+        .where(
+            MessageRecipient.message_id == any_(ids),
+            MessageRecipient.message_timestamp.between(first, last),
+        )
+        .returning(*(MessageRecipient.__table__.c[name] for name in RECIPIENT_COLUMNS))
+        .cte("moved")
+    )
+    archived = (
+        insert(ArchivedMessageRecipient)
+        .from_select(RECIPIENT_COLUMNS, select(moved))
+        .cte("archived")
+    )
+    result = await db.execute(
+        select(moved.c.recipient_id, func.count().filter(moved.c.read == False))
+        .group_by(moved.c.recipient_id)
+        .add_cte(archived)
+    )
+    # every recipient and sender loses the messages from their listings;
+    # deliveries never read also come off the unread counters
+    decrements = dict.fromkeys({UUID(str(row.sender_id)) for row in batch}, 0)
+    decrements.update((UUID(str(user_id)), unread) for user_id, unread in result)
+    await decrement_unread_counts(db, decrements)
+    await db.execute(
+        delete(Message).where(
+            Message.id == any_(ids), Message.timestamp.between(first, last)
+        )
+    )
+    return len(batch)
+
+
+# archive everything older than retention_days in batches, then drop the
+# partitions that were emptied; returns messages moved and partitions dropped
+async def archive_messages(
+    retention_days: int = RETENTION_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE
+) -> tuple[int, list[str]]:
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    archived = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            moved = await archive_batch(db, cutoff, batch_size)
+            await db.commit()
+            if not moved:
+                break
+            archived += moved
+        dropped = await drop_partitions(db, cutoff)
+        await db.commit()
+    return archived, dropped
+
+
+async def maintain_retention():
+    """Archive expired messages for as long as the worker runs."""
+    while True:
+        try:
+            archived, dropped = await archive_messages()
+            if archived or dropped:
+                logger.info(
+                    "Archived %d messages, dropped partitions %s",
+                    archived,
+                    ", ".join(dropped) or "none",
+                )
+        except (OSError, SQLAlchemyError):
+            logger.exception("Archiving messages failed, retrying")
+        await asyncio.sleep(ARCHIVE_CHECK_SECONDS)
@@ -0,0 +1,75 @@
+# Maintenance commands: python -m app.commands <command>
+import argparse
+import asyncio
+
+from app.archive import ARCHIVE_BATCH_SIZE, RETENTION_DAYS, archive_messages
+from app.db import AsyncSessionLocal
+from app.partitions import PARTITION_MONTHS_AHEAD, ensure_partitions
+from app.service import reconcile_unread_counts
+
+
+async def reconcile_unread(args: argparse.Namespace):
+    """Rebuild mailbox unread counters from message_recipients."""
+    async with AsyncSessionLocal() as db:
+        corrected = await reconcile_unread_counts(db)
+    print(f"Reconciled unread counters, {corrected} corrected")
+
+
+async def create_partitions(args: argparse.Namespace):
+    """Create monthly message partitions from this month on."""
+    created = await ensure_partitions(args.months_ahead)
+    print(f"Created {len(created)} partitions")
+    for name in created:
+        print(f"  {name}")
+
+
+async def archive(args: argparse.Namespace):
+    """Move messages older than the retention period to the archive tables."""
+    archived, dropped = await archive_messages(args.days, args.batch_size)
+    print(f"Archived {archived} messages, dropped {len(dropped)} partitions")
+    for name in dropped:
+        print(f"  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reconcile = commands.add_parser("reconcile-unread", help=reconcile_unread.__doc__)
+    reconcile.set_defaults(handler=reconcile_unread)
+
+    partitions = commands.add_parser(
+        "create-partitions", help=create_partitions.__doc__
+    )
+    partitions.add_argument(
+        "--months-ahead",
+        type=int,
+        default=PARTITION_MONTHS_AHEAD,
+        help="months to create past the current one",
+    )
+    partitions.set_defaults(handler=create_partitions)
+
+    archiver = commands.add_parser("archive", help=archive.__doc__)
+    archiver.add_argument(
+        "--days",
+        type=int,
+        default=RETENTION_DAYS,
+        help="archive messages older than this many days (default RETENTION_DAYS)",
+    )
+    archiver.add_argument(
+        "--batch-size",
+        type=int,
+        default=ARCHIVE_BATCH_SIZE,
+        help="messages moved per transaction",
+    )
+    archiver.set_defaults(handler=archive)
+
+    args = parser.parse_args()
+    # RETENTION_DAYS=0 means keep everything, not archive everything
+    if args.command == "archive" and args.days <= 0:
+        parser.error("archive needs --days or RETENTION_DAYS above 0")
+    asyncio.run(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Conditional GET for mailbox listings
+#
+# Every change to a user's inbox, unread or sent listings bumps the version on
+# their mailbox_counters row (see app/service.py). A listing's ETag is derived
+# from that version, so a poll carrying If-None-Match is answered with 304
+# after one primary-key lookup, without running the listing query.
+import hashlib
+from typing import Awaitable, Callable
+from uuid import UUID
+
+from fastapi import Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.pagination import page_response
+from app.service import get_mailbox_version
+
+# clients may keep the page, but must revalidate it before each use
+CACHE_CONTROL = "private, no-cache"
+
+
+def listing_etag(request: Request, user_id: UUID, version: int) -> str:
+    """Strong ETag of one listing page as of a mailbox version.
+
+    The path and query tell apart the listings, pages and summary forms that
+    share a version.
+    """
+    key = f"{user_id}:{version}:{request.url.path}?{request.url.query}"
+    return f'"{hashlib.blake2b(key.encode(), digest_size=12).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether If-None-Match names `etag`, compared weakly as RFC 9110 asks."""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+async def conditional_page(
+    request: Request,
+    db: AsyncSession,
+    user_id: UUID,
+    listing: Callable[[], Awaitable[tuple[list, str | None]]],
+) -> Response:
+    """Run `listing` into a page response, unless the client's copy is current.
+
+    The version is read before the listing: a change committed in between
+    makes the page newer than its ETag, which costs the client one more full
+    response, never a stale one.
+    """
+    version = await get_mailbox_version(db, user_id)
+    headers = {"ETag": listing_etag(request, user_id, version)}
+    headers["Cache-Control"] = CACHE_CONTROL
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response = page_response(await listing())
+    response.headers.update(headers)
+    return response
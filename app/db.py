@@ -1,9 +1,21 @@
 # DB connection setup
+import hashlib
+import hmac
+import itertools
+import math
 import os
+import time
+from contextvars import ContextVar
+from http.cookies import SimpleCookie
+from uuid import UUID
 
 from dotenv import load_dotenv
+from sqlalchemy import bindparam, exc
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 load_dotenv()
 
@@ -17,19 +29,253 @@ DATABASE_URL = (
     f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
 
+APP_ENV = os.getenv("APP_ENV", "development")
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+# Pool sizing: workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below the
+# server's max_connections.
+DB_ECHO = _env_flag("DB_ECHO", APP_ENV != "production")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = _env_flag("DB_POOL_PRE_PING", False)
+# prepared statements cached per connection; 0 when behind pgbouncer
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
 # Create async engine
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine_options = dict(
+    echo=DB_ECHO,
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+)
+engine = create_async_engine(DATABASE_URL, **engine_options)
 
 # Create sessionmaker
 AsyncSessionLocal = sessionmaker(
     bind=engine, class_=AsyncSession, expire_on_commit=False
 )
 
+# Optional read replicas (comma-separated postgresql+asyncpg:// URLs). Reads
+# are spread over them round robin; a user who just wrote keeps reading from
+# the primary for DB_STICKY_SECONDS so they see their own writes.
+#
+# The stickiness travels with the client rather than living in one worker: a
+# write sets a cookie holding the user id and the wall-clock time until which
+# their reads stay on the primary, signed with SECRET_KEY. Whichever worker
+# serves the next request, before or after a restart, routes it the same way.
+DB_REPLICA_URLS = [
+    url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",") if url.strip()
+]
+DB_STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", "5"))
+STICKY_COOKIE = "primary_until"
+STICKY_SIGNING_KEY = os.getenv("SECRET_KEY", "").encode()
+
+replica_engines = [
+    create_async_engine(url, **engine_options) for url in DB_REPLICA_URLS
+]
+ReplicaSessionLocals = [
+    sessionmaker(bind=replica, class_=AsyncSession, expire_on_commit=False)
+    for replica in replica_engines
+]
+_replica_turn = itertools.count()
+
+
+class Stickiness:
+    """Whose reads stay on the primary, and until when, for this request."""
+
+    __slots__ = ("user_id", "until", "written")
+
+    def __init__(self, user_id: str | None = None, until: float = 0.0):
+        self.user_id = user_id
+        self.until = until
+        self.written = False
+
+
+# set per request by StickinessMiddleware from the incoming cookie
+current_stickiness: ContextVar[Stickiness | None] = ContextVar(
+    "current_stickiness", default=None
+)
+
+
+def _sign_stickiness(user_id: str, until: str) -> str:
+    message = f"{user_id}:{until}".encode()
+    return hmac.new(STICKY_SIGNING_KEY, message, hashlib.sha256).hexdigest()
+
+
+def encode_stickiness(user_id: str, until: float) -> str:
+    until = f"{until:.3f}"
+    return f"{user_id}:{until}:{_sign_stickiness(user_id, until)}"
+
+
+def decode_stickiness(value: str) -> Stickiness | None:
+    """The cookie's stickiness, or None when it is malformed or forged."""
+    try:
+        user_id, until, signature = value.split(":")
+        expected = _sign_stickiness(user_id, until)
+        if hmac.compare_digest(signature, expected):
+            return Stickiness(user_id, float(until))
+    except ValueError:
+        pass
+    return None
+
+
+def record_write(user_id):
+    """Pin a user's reads to the primary for the stickiness window."""
+    stickiness = current_stickiness.get()
+    if not replica_engines or stickiness is None:
+        return
+    stickiness.user_id = str(user_id)
+    stickiness.until = time.time() + DB_STICKY_SECONDS
+    stickiness.written = True
+
+
+def read_sessionmaker(user_id=None) -> sessionmaker:
+    """Sessionmaker for a read-only request, primary or a replica."""
+    if not ReplicaSessionLocals:
+        return AsyncSessionLocal
+    stickiness = current_stickiness.get()
+    if (
+        user_id is not None
+        and stickiness is not None
+        and stickiness.user_id == str(user_id)
+        and stickiness.until > time.time()
+    ):
+        return AsyncSessionLocal
+    return ReplicaSessionLocals[next(_replica_turn) % len(ReplicaSessionLocals)]
+
+
+class StickinessMiddleware:
+    """Read the stickiness cookie of a request and renew it after a write.
+
+    A plain ASGI middleware like MetricsMiddleware, so streaming responses
+    pass through untouched. Does nothing without replicas.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replica_engines:
+            await self.app(scope, receive, send)
+            return
+
+        stickiness = Stickiness()
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                cookies = SimpleCookie(value.decode("latin-1"))
+                if STICKY_COOKIE in cookies:
+                    stickiness = (
+                        decode_stickiness(cookies[STICKY_COOKIE].value) or stickiness
+                    )
+        token = current_stickiness.set(stickiness)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and stickiness.written:
+                cookie = (
+                    f"{STICKY_COOKIE}="
+                    f"{encode_stickiness(stickiness.user_id, stickiness.until)}; "
+                    f"Max-Age={math.ceil(DB_STICKY_SECONDS)}; Path=/; "
+                    "HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"set-cookie", cookie.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            current_stickiness.reset(token)
+
+
 # Base class for models
 Base = declarative_base()
 
 
+# live pool usage, for sizing workers against max_connections
+def pool_stats(pool: InstrumentedPool | None = None) -> dict:
+    pool = pool or engine.pool
+    return {
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "checkouts": pool.checkouts,
+        "timeouts": pool.timeouts,
+        "wait_seconds_total": pool.wait_seconds_total,
+        "wait_seconds_max": pool.wait_seconds_max,
+    }
+
+
 # Dependency to get DB session in route
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+
+# Dependency for anonymous read-only routes, may be served by a replica
+async def get_read_db():
+    async with read_sessionmaker()() as session:
+        yield session
+
+
+# Dependency for reads about one user, e.g. GET /users/{user_id}: a client
+# that just created the user reads it from the primary like their own writes
+async def get_user_read_db_by_id(user_id: UUID):
+    async with read_sessionmaker(user_id)() as session:
+        yield session
+
+
+# bind a list of ids as a single uuid[] parameter; an expanding IN takes one
+# parameter per id and fails past asyncpg's limit of 32767
+def uuid_array(ids: list):
+    return bindparam(None, ids, type_=ARRAY(PG_UUID(as_uuid=True)))
+
+
+# Bulk load rows with COPY on the session's connection. The session must have
+# executed a statement already so the COPY runs inside its transaction.
+async def copy_records(
+    session: AsyncSession, table_name: str, columns: list[str], records: list[tuple]
+):
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        table_name, records=records, columns=columns
+    )
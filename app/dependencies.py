@@ -1,17 +1,35 @@
 # here me config my auth jwt
+import hashlib
 import os
+import time
 from datetime import datetime, timedelta, timezone
+from threading import Lock
+from uuid import uuid4
 
 import jwt
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
+
+from app.cache import LRUCache
+from app.db import AsyncSessionLocal, read_sessionmaker
+from app.models import RevokedToken
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_DAYS = int(os.getenv("ACCESS_TOKEN_EXPIRE_DAYS"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+# verified claims by token, each entry expires with the token's exp
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+# revocation key -> exp, kept until the token would have expired anyway. A
+# mirror of the revoked_tokens table: loaded at startup and, with the postgres
+# realtime backend, kept current by NOTIFYs from the other workers
+revoked_tokens: dict[str, float] = {}
+_revoked_lock = Lock()
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -20,7 +38,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     expire = datetime.now(timezone.utc) + (
         expires_delta or timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
     )
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid4().hex})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
@@ -40,11 +58,80 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
 def get_current_user(token: str = Depends(oauth2_scheme)):
     """Extract user from JWT token and verify login status."""
+    return user_id_from_token(token)
+
+
+async def get_user_read_db(current_user: str = Depends(get_current_user)):
+    """DB session for a read-only route, honouring read-your-writes."""
+    async with read_sessionmaker(current_user)() as session:
+        yield session
+
+
+def user_id_from_token(token: str) -> str:
+    """Verify a JWT token and return the user id it was issued for."""
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = decode_access_token(token)
+        if "error" in payload:
+            raise _unauthorized(payload["error"])
+        token_cache.set(token, payload, expires_at=payload["exp"])
+    if _revocation_key(token, payload) in revoked_tokens:
+        raise _unauthorized("Token revoked")
+    return payload["id"]
+
+
+def revoke_token(token: str) -> tuple[str, float]:
+    """Reject a token from now on, until it expires.
+
+    Returns the revocation key and exp for the caller to persist.
+    """
     payload = decode_access_token(token)
     if "error" in payload:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=payload["error"],
-            headers={"WWW-Authenticate": "Bearer"},
+        raise _unauthorized(payload["error"])
+    key = _revocation_key(token, payload)
+    remember_revocation(key, payload["exp"])
+    token_cache.pop(token)
+    return key, payload["exp"]
+
+
+# add a revocation to this worker's mirror, dropping the expired ones
+def remember_revocation(key: str, exp: float):
+    now = time.time()
+    with _revoked_lock:
+        for revoked, revoked_exp in list(revoked_tokens.items()):
+            if revoked_exp <= now:
+                del revoked_tokens[revoked]
+        if exp > now:
+            revoked_tokens[key] = exp
+
+
+async def load_revoked_tokens():
+    """Fill the mirror from the revoked_tokens table."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(RevokedToken.key, RevokedToken.expires_at).where(
+                RevokedToken.expires_at > now
+            )
         )
-    return payload["id"]
+        rows = result.all()
+    with _revoked_lock:
+        for key, expires_at in rows:
+            revoked_tokens[key] = expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def token_cache_stats() -> dict:
+    return {**token_cache.stats(), "revoked": len(revoked_tokens)}
+
+
+def _revocation_key(token: str, payload: dict) -> str:
+    # tokens issued before jti was added are revoked by digest
+    return payload.get("jti") or hashlib.sha256(token.encode()).hexdigest()
+
+
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
@@ -1,9 +1,43 @@
 # Entry point for FastAPI app
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
 from fastapi import FastAPI
 
+from app.archive import RETENTION_DAYS, maintain_retention
+from app.db import StickinessMiddleware, engine, replica_engines
+from app.dependencies import load_revoked_tokens
+from app.metrics import MetricsMiddleware
+from app.partitions import maintain_partitions
+from app.realtime import REALTIME_BACKEND, listen_for_messages
 from app.routes import router
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # tokens revoked before this worker started, or by another one
+    await load_revoked_tokens()
+    # monthly partitions of messages are created ahead of time by every worker
+    tasks = [asyncio.create_task(maintain_partitions())]
+    # expired messages are archived in small batches, idle until configured
+    if RETENTION_DAYS:
+        tasks.append(asyncio.create_task(maintain_retention()))
+    # multi-worker deployments relay new messages through Postgres LISTEN/NOTIFY
+    if REALTIME_BACKEND == "postgres":
+        tasks.append(asyncio.create_task(listen_for_messages()))
+    yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    # pooled connections belong to this event loop, close them with it
+    for db_engine in (engine, *replica_engines):
+        await db_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(StickinessMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get("/")
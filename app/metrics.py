@@ -0,0 +1,308 @@
+# In-process metrics in the Prometheus text exposition format
+#
+# Kept dependency-free like app/cache.py: a handful of counters and
+# fixed-bucket histograms updated in place and rendered on scrape. Each
+# worker exposes its own numbers; Prometheus sums them across targets.
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+
+from sqlalchemy import event
+
+from app.db import _env_flag, engine, pool_stats, replica_engines
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+FANOUT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+# debug aid: report each request's SQL usage in response headers
+DB_QUERY_HEADERS = _env_flag("DB_QUERY_HEADERS", False)
+QUERY_COUNT_HEADER = "X-DB-Query-Count"
+QUERY_TIME_HEADER = "X-DB-Time-Ms"
+# log a warning for requests running more statements than this, 0 disables
+DB_QUERY_BUDGET = int(os.getenv("DB_QUERY_BUDGET", "0"))
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values."""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: dict[tuple, list] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                    0,
+                ]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [
+                (key, list(counts), s, n)
+                for key, (counts, s, n) in self._series.items()
+            ]
+        for key, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = _labels(self.labels + ("le",), key + (str(bound),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series: dict[tuple, float] = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests handled", ("method", "route", "status")
+)
+http_latency = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency",
+    ("method", "route"),
+    LATENCY_BUCKETS,
+)
+db_queries = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed per HTTP request",
+    ("route",),
+    QUERY_COUNT_BUCKETS,
+)
+db_time = Histogram(
+    "db_query_seconds_per_request",
+    "Time spent executing SQL per HTTP request",
+    ("route",),
+    LATENCY_BUCKETS,
+)
+message_fanout = Histogram(
+    "message_fanout_recipients",
+    "Recipients per sent message",
+    (),
+    FANOUT_BUCKETS,
+)
+db_errors = Counter(
+    "db_statement_errors_total",
+    "SQL statements that raised an error",
+    (),
+)
+sends_throttled = Counter(
+    "sends_throttled_total",
+    "Sends rejected by admission control",
+    ("reason",),
+)
+send_queue_wait = Histogram(
+    "send_queue_wait_seconds",
+    "Time sends waited for a slot when all were taken",
+    (),
+    LATENCY_BUCKETS,
+)
+
+
+class QueryStats:
+    """SQL statements and time accumulated by the current request."""
+
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# set per request by MetricsMiddleware; copied into the greenlets and
+# threadpool workers the request runs on, which share the same object
+current_query_stats: ContextVar[QueryStats | None] = ContextVar(
+    "current_query_stats", default=None
+)
+
+
+# the start time lives on the statement's execution context, so a statement
+# that fails can't leave it behind for the next one on the connection
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _count_statement(context)
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is None or not hasattr(context, "_query_start"):
+        # failed before reaching the cursor, e.g. while connecting
+        return
+    db_errors.inc()
+    _count_statement(context)
+
+
+def _count_statement(context):
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += time.perf_counter() - context._query_start
+
+
+for _engine in (engine, *replica_engines):
+    event.listen(_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(_engine.sync_engine, "handle_error", _handle_error)
+
+
+class MetricsMiddleware:
+    """Time every HTTP request and record its route, status and DB usage.
+
+    A plain ASGI middleware rather than BaseHTTPMiddleware so streaming
+    responses pass through untouched. Requests are labelled by route
+    template, e.g. /messages/{message_id}, to keep the series bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if DB_QUERY_HEADERS:
+                    # statements run while streaming the body are not included
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (QUERY_COUNT_HEADER.encode(), str(stats.count).encode()),
+                        (
+                            QUERY_TIME_HEADER.encode(),
+                            f"{stats.seconds * 1000:.2f}".encode(),
+                        ),
+                    ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_query_stats.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_requests.inc(scope["method"], path, status)
+            http_latency.observe(elapsed, scope["method"], path)
+            db_queries.observe(stats.count, path)
+            db_time.observe(stats.seconds, path)
+            if DB_QUERY_BUDGET and stats.count > DB_QUERY_BUDGET:
+                logger.warning(
+                    "%s %s ran %d SQL statements (budget %d) in %.1f ms",
+                    scope["method"],
+                    path,
+                    stats.count,
+                    DB_QUERY_BUDGET,
+                    stats.seconds * 1000,
+                )
+
+
+def _pool_gauges() -> list[str]:
+    pools = [("primary", engine.pool)] + [
+        (f"replica-{i}", replica.pool) for i, replica in enumerate(replica_engines)
+    ]
+    gauges = {
+        "db_pool_size": ("size", "gauge", "Connections kept open by the pool"),
+        "db_pool_checked_out": ("checked_out", "gauge", "Connections in use"),
+        "db_pool_overflow": (
+            "overflow",
+            "gauge",
+            "Connections opened past the pool size",
+        ),
+        "db_pool_checkouts_total": ("checkouts", "counter", "Connection checkouts"),
+        "db_pool_timeouts_total": ("timeouts", "counter", "Checkouts that timed out"),
+        "db_pool_wait_seconds_total": (
+            "wait_seconds_total",
+            "counter",
+            "Time spent waiting for a connection",
+        ),
+    }
+    stats = [(name, pool_stats(pool)) for name, pool in pools]
+    lines = []
+    for metric, (key, kind, help) in gauges.items():
+        lines += [f"# HELP {metric} {help}", f"# TYPE {metric} {kind}"]
+        lines += [
+            f"{metric}{_labels(('pool',), (name,))} {pool[key]}" for name, pool in stats
+        ]
+    return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (
+        http_requests,
+        http_latency,
+        db_queries,
+        db_time,
+        db_errors,
+        message_fanout,
+        sends_throttled,
+        send_queue_wait,
+    ):
+        lines += metric.render()
+    lines += _pool_gauges()
+    return "\n".join(lines) + "\n"
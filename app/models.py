@@ -2,9 +2,11 @@
 import uuid
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, String, Text
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship
+from sqlalchemy import (BigInteger, Boolean, Column, Computed, DateTime,
+                        ForeignKey, ForeignKeyConstraint, Index, Integer,
+                        String, Text)
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
+from sqlalchemy.orm import deferred, relationship
 
 from app.db import Base
 
@@ -24,7 +26,35 @@ class User(Base):
         "MessageRecipient", back_populates="recipient", cascade="all, delete"
     )
 
+    # directory search, name / email ILIKE '%q%', is served by trigram
+    # indexes that migration 03cd5dc0491b creates only where pg_trgm is
+    # available. They are left out here so their absence isn't schema drift.
+    __table_args__ = (
+        # directory paging: ORDER BY created_at DESC, id DESC
+        Index("ix_users_created_at_id", created_at.desc(), id.desc()),
+    )
+
+
+# optional indexes, ignored when comparing the database with the models
+OPTIONAL_INDEXES = {"ix_users_name_trgm", "ix_users_email_trgm"}
+
+
+# A thread of messages: a new message starts one, replies join their parent's
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
+    messages = relationship("Message", back_populates="conversation")
+    participants = relationship(
+        "ConversationParticipant", back_populates="conversation", cascade="all, delete"
+    )
+
+
+# Range partitioned by month on timestamp (app/partitions.py). The partition
+# key has to be part of the primary key, so a message is identified by
+# (id, timestamp); lookups by id alone probe every partition's index.
 class Message(Base):
     __tablename__ = "messages"
 
@@ -32,23 +62,133 @@ class Message(Base):
     sender_id = Column(
         UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False
     )
+    conversation_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("conversations.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # not a foreign key, that would need the parent's timestamp as well
+    reply_to_id = Column(UUID(as_uuid=True), nullable=True)
     subject = Column(String, nullable=True)
     content = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    # leading characters of content, written at send time for summary listings
+    snippet = Column(String, nullable=False)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    # full-text search document, subject weighted above content; deferred so
+    # ordinary message loads don't fetch it
+    search_vector = deferred(
+        Column(
+            TSVECTOR,
+            Computed(
+                "setweight(to_tsvector('english', coalesce(subject, '')), 'A') || "
+                "setweight(to_tsvector('english', content), 'B')",
+                persisted=True,
+            ),
+        )
+    )
 
     sender = relationship("User", back_populates="sent_messages")
+    conversation = relationship("Conversation", back_populates="messages")
     recipients = relationship(
         "MessageRecipient", back_populates="message", cascade="all, delete"
     )
 
+    __table_args__ = (
+        # sent folder: WHERE sender_id = ? ORDER BY timestamp DESC, id DESC
+        Index(
+            "ix_messages_sender_id_timestamp", sender_id, timestamp.desc(), id.desc()
+        ),
+        # message search: WHERE search_vector @@ query
+        Index("ix_messages_search_vector", search_vector, postgresql_using="gin"),
+        # thread view: WHERE conversation_id = ? ORDER BY timestamp DESC, id DESC
+        Index(
+            "ix_messages_conversation_id_timestamp",
+            conversation_id,
+            timestamp.desc(),
+            id.desc(),
+        ),
+        # archiver: WHERE timestamp < ? ORDER BY timestamp
+        Index("ix_messages_timestamp", timestamp),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
 
+# Partitioned like messages, on the timestamp of the message it delivers
 class MessageRecipient(Base):
     __tablename__ = "message_recipients"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    message_timestamp = Column(DateTime, primary_key=True)
+    recipient_id = Column(
+        UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+    read = Column(Boolean, default=False)
+    read_at = Column(DateTime, nullable=True)
+
+    message = relationship("Message", back_populates="recipients")
+    recipient = relationship("User", back_populates="received_messages")
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [message_id, message_timestamp],
+            ["messages.id", "messages.timestamp"],
+            name="message_recipients_message_id_fkey",
+            ondelete="CASCADE",
+        ),
+        # inbox: WHERE recipient_id = ? ORDER BY message_timestamp DESC, id DESC
+        Index(
+            "ix_message_recipients_recipient_id_timestamp",
+            recipient_id,
+            message_timestamp.desc(),
+            id.desc(),
+        ),
+        # unread: WHERE recipient_id = ? AND read = false
+        # ORDER BY message_timestamp DESC, message_id DESC
+        Index(
+            "ix_message_recipients_unread",
+            recipient_id,
+            message_timestamp.desc(),
+            message_id.desc(),
+            postgresql_where=(read == False),
+        ),
+        # recipients of a message (sent folder, GET /messages/{id}, cascades)
+        Index("ix_message_recipients_message_id", message_id),
+        {"postgresql_partition_by": "RANGE (message_timestamp)"},
+    )
+
+
+# Messages past the retention period, moved out of messages by app/archive.py.
+# Read only by GET /messages/{id}, so there is no search_vector and only the
+# indexes the lookup and user deletion need.
+class ArchivedMessage(Base):
+    __tablename__ = "archived_messages"
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    sender_id = Column(
+        UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+    conversation_id = Column(UUID(as_uuid=True), nullable=False)
+    reply_to_id = Column(UUID(as_uuid=True), nullable=True)
+    subject = Column(String, nullable=True)
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    recipients = relationship(
+        "ArchivedMessageRecipient", back_populates="message", cascade="all, delete"
+    )
+
+    __table_args__ = (Index("ix_archived_messages_sender_id", sender_id),)
+
+
+class ArchivedMessageRecipient(Base):
+    __tablename__ = "archived_message_recipients"
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
     message_id = Column(
         UUID(as_uuid=True),
-        ForeignKey("messages.id", ondelete="CASCADE"),
+        ForeignKey("archived_messages.id", ondelete="CASCADE"),
         nullable=False,
     )
     recipient_id = Column(
@@ -57,5 +197,66 @@ class MessageRecipient(Base):
     read = Column(Boolean, default=False)
     read_at = Column(DateTime, nullable=True)
 
-    message = relationship("Message", back_populates="recipients")
-    recipient = relationship("User", back_populates="received_messages")
+    message = relationship("ArchivedMessage", back_populates="recipients")
+
+    __table_args__ = (
+        Index("ix_archived_message_recipients_message_id", message_id),
+        Index("ix_archived_message_recipients_recipient_id", recipient_id),
+    )
+
+
+# Per-user counters kept in step with message_recipients by the service layer
+class MailboxCounter(Base):
+    __tablename__ = "mailbox_counters"
+
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # bumped by every change to the user's inbox, unread or sent listings;
+    # listing ETags are derived from it
+    version = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+
+# Membership of a conversation with the latest message the participant can
+# see, kept current by send_message so listing conversations reads one row
+# per conversation instead of aggregating messages
+class ConversationParticipant(Base):
+    __tablename__ = "conversation_participants"
+
+    conversation_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("conversations.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    last_message_id = Column(UUID(as_uuid=True), nullable=False)
+    last_message_at = Column(DateTime, nullable=False)
+
+    conversation = relationship("Conversation", back_populates="participants")
+
+    __table_args__ = (
+        # conversation list: WHERE user_id = ? ORDER BY last_message_at DESC
+        Index(
+            "ix_conversation_participants_user_id_last_message_at",
+            user_id,
+            last_message_at.desc(),
+            conversation_id.desc(),
+        ),
+    )
+
+
+# Tokens revoked by logout, kept until they would have expired anyway. Every
+# worker loads them into app.dependencies.revoked_tokens at startup.
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    # jti of the token, or its sha256 for tokens issued without one
+    key = Column(String, primary_key=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,117 @@
+# Keyset (cursor) pagination helpers
+import base64
+import json
+from datetime import datetime, timezone
+from uuid import UUID
+
+import orjson
+from fastapi import HTTPException, Response
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def _encode(values: list) -> str:
+    raw = json.dumps(values, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode(cursor: str) -> list:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded))
+
+
+def encode_cursor(timestamp: datetime, row_id: UUID) -> str:
+    """Encode a (timestamp, id) sort key into an opaque cursor string."""
+    return _encode([timestamp.isoformat(), str(row_id)])
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    """Decode a cursor produced by encode_cursor."""
+    try:
+        timestamp, row_id = _decode(cursor)
+        timestamp, row_id = datetime.fromisoformat(timestamp), UUID(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # timestamps are stored as naive UTC, which an aware value can't be
+    # compared with
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp, row_id
+
+
+def encode_rank_cursor(rank: float, row_id: UUID) -> str:
+    """Encode a (relevance rank, id) sort key into an opaque cursor string."""
+    return _encode([rank, str(row_id)])
+
+
+def decode_rank_cursor(cursor: str) -> tuple[float, UUID]:
+    """Decode a cursor produced by encode_rank_cursor."""
+    try:
+        rank, row_id = _decode(cursor)
+        return float(rank), UUID(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(
+    rows: list, limit: int, key, encode=encode_cursor
+) -> tuple[list, str | None]:
+    """Trim a limit + 1 fetch to one page and build the cursor for the next.
+
+    `key` maps the last row of the page to its sort key, (timestamp, id)
+    unless another `encode` function is given.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode(*key(page[-1]))
+
+
+def keyset(stmt, timestamp_col, id_col, cursor: str | None, limit: int | None):
+    """Apply newest-first (timestamp, id) keyset ordering to a select.
+
+    Fetches one row more than `limit` so the caller can tell whether another
+    page exists without issuing a COUNT. A `limit` of None reads to the end.
+    """
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        stmt = stmt.where(
+            # redundant with the row comparison, which partition pruning can't use
+            timestamp_col <= timestamp,
+            tuple_(timestamp_col, id_col) < tuple_(timestamp, row_id),
+        )
+    stmt = stmt.order_by(timestamp_col.desc(), id_col.desc())
+    return stmt if limit is None else stmt.limit(limit + 1)
+
+
+def with_next_cursor(response: Response, page: tuple[list, str | None]) -> list:
+    """Expose the next cursor as a response header and return the page items."""
+    items, next_cursor = page
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return items
+
+
+class OrjsonResponse(Response):
+    """JSON encoded by orjson, which handles UUIDs and datetimes natively.
+
+    Returning it from a route skips FastAPI's response_model validation, so
+    the content must already have the documented shape.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        # asyncpg returns its own uuid.UUID subclass, which orjson only
+        # encodes through `default`
+        return orjson.dumps(content, default=str)
+
+
+def page_response(page: tuple[list, str | None]) -> OrjsonResponse:
+    """Encode a page of plain rows, with the next cursor as a header."""
+    items, next_cursor = page
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return OrjsonResponse(items, headers=headers)
@@ -0,0 +1,142 @@
+# Monthly range partitions of messages and message_recipients
+#
+# messages is partitioned on timestamp and message_recipients on the
+# message_timestamp copied from its message, so a month of mail and its
+# deliveries sit in partitions with the same suffix, e.g. messages_p2026_10
+# and message_recipients_p2026_10. A row for a month without a partition is
+# rejected, so every worker creates the coming PARTITION_MONTHS_AHEAD months
+# at startup and then every PARTITION_CHECK_SECONDS; `python -m app.commands
+# create-partitions` does the same by hand or from cron.
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# parents in creation order: a month's messages partition before its deliveries
+PARTITIONED_TABLES = ("messages", "message_recipients")
+# every query plans against each partition, empty ones included, so keep
+# only as many future months as the check interval needs
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "1"))
+PARTITION_CHECK_SECONDS = float(os.getenv("PARTITION_CHECK_SECONDS", "3600"))
+# give up on a busy parent rather than queue every query behind the attach
+PARTITION_LOCK_TIMEOUT = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+PARTITION_NAME = re.compile(r"^(messages|message_recipients)_p\d{4}_\d{2}$")
+# pg_advisory_xact_lock key serialising partition creation across workers
+_LOCK_KEY = 0x6D736770
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+# month is a month_start
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+# serialise partition changes across workers for the rest of the transaction
+# and return the names of the existing partitions
+async def _lock_partitions(db: AsyncSession) -> set[str]:
+    await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+    await db.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+    result = await db.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "WHERE parent.relname = ANY(:tables)"
+        ),
+        {"tables": list(PARTITIONED_TABLES)},
+    )
+    return set(result.scalars())
+
+
+# create the missing partitions for every month from start to end, in the
+# caller's transaction; returns the names created
+async def create_partitions(
+    db: AsyncSession, start: datetime, end: datetime
+) -> list[str]:
+    existing = await _lock_partitions(db)
+    created = []
+    month = month_start(start)
+    while month <= end:
+        bounds = (
+            f"FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+        for table in PARTITIONED_TABLES:
+            name = partition_name(table, month)
+            if name in existing:
+                continue
+            # create then attach: ATTACH PARTITION lets queries on the parent
+            # carry on, CREATE TABLE ... PARTITION OF would block them
+            await db.execute(
+                text(
+                    f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS "
+                    "INCLUDING GENERATED INCLUDING CONSTRAINTS)"
+                )
+            )
+            await db.execute(
+                text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds}")
+            )
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+# drop the empty partitions of months that ended before `before`, in the
+# caller's transaction; returns the names dropped. Deliveries go first, their
+# foreign key refers to the messages partition.
+async def drop_partitions(db: AsyncSession, before: datetime) -> list[str]:
+    existing = await _lock_partitions(db)
+    dropped = []
+    for table in reversed(PARTITIONED_TABLES):
+        for name in sorted(existing):
+            if not name.startswith(f"{table}_p"):
+                continue
+            month = datetime.strptime(name.removeprefix(f"{table}_p"), "%Y_%m")
+            if add_months(month, 1) > before:
+                continue
+            empty = await db.execute(text(f"SELECT NOT EXISTS (SELECT FROM {name})"))
+            if not empty.scalar():
+                continue
+            # detaching checks and removes the foreign keys into the partition,
+            # which a plain DROP TABLE refuses to do
+            await db.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            await db.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
+
+
+# partitions from the current month through PARTITION_MONTHS_AHEAD months on
+async def ensure_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> list[str]:
+    month = month_start(datetime.utcnow())
+    async with AsyncSessionLocal() as db:
+        created = await create_partitions(db, month, add_months(month, months_ahead))
+        await db.commit()
+    return created
+
+
+async def maintain_partitions():
+    """Keep future partitions in place for as long as the worker runs."""
+    while True:
+        try:
+            created = await ensure_partitions()
+            if created:
+                logger.info("Created partitions %s", ", ".join(created))
+        except (OSError, SQLAlchemyError):
+            logger.exception("Creating partitions failed, retrying")
+        await asyncio.sleep(PARTITION_CHECK_SECONDS)
@@ -0,0 +1,229 @@
+# Real-time delivery of new messages over SSE / WebSocket
+#
+# Every worker keeps an in-process hub of connected users. With the "local"
+# backend send_message publishes to the hub of the worker that handled it,
+# which is enough for a single worker. With the "postgres" backend it issues
+# a NOTIFY inside its transaction instead; Postgres delivers it on commit to
+# every worker's LISTEN connection and each worker looks up the recipient
+# rows of its own connected users. The payload carries the message timestamp
+# so the lookup only searches the message's partition.
+#
+# The same LISTEN connection relays token revocations from logout into every
+# worker's mirror of the revoked_tokens table (app/dependencies.py).
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from uuid import UUID
+
+import asyncpg
+from fastapi import WebSocket, WebSocketDisconnect
+from sqlalchemy import any_, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import AsyncSessionLocal, engine, uuid_array
+from app.dependencies import load_revoked_tokens, remember_revocation
+from app.models import Message, MessageRecipient
+
+logger = logging.getLogger(__name__)
+
+REALTIME_BACKEND = os.getenv("REALTIME_BACKEND", "local")  # local | postgres
+NOTIFY_CHANNEL = "new_messages"
+REVOKE_CHANNEL = "revoked_tokens"
+# events buffered per connection before the oldest are dropped
+QUEUE_SIZE = int(os.getenv("REALTIME_QUEUE_SIZE", "100"))
+KEEPALIVE_SECONDS = 15
+RECONNECT_SECONDS = 5
+
+
+class Hub:
+    """Fan events out to the queues of connected users."""
+
+    def __init__(self):
+        self._queues: dict[str, set[asyncio.Queue]] = {}
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._queues.setdefault(str(user_id), set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._queues.get(str(user_id))
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._queues[str(user_id)]
+
+    def connected(self) -> list[str]:
+        return list(self._queues)
+
+    def is_connected(self, user_id: str) -> bool:
+        return str(user_id) in self._queues
+
+    def publish(self, user_id: str, event: str):
+        for queue in self._queues.get(str(user_id), ()):
+            if queue.full():
+                # slow consumer: drop the oldest event, the inbox still has it
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+hub = Hub()
+
+
+def _event(row_id, message_id, sender_id, subject, content, timestamp) -> str:
+    # serialised once and shared by every connection of the recipient
+    return json.dumps(
+        {
+            "id": str(row_id),
+            "message_id": str(message_id),
+            "sender_id": str(sender_id),
+            "subject": subject,
+            "content": content,
+            "timestamp": timestamp.isoformat(),
+            "read": False,
+            "read_at": None,
+        }
+    )
+
+
+def notify_payload(message_id: UUID, timestamp: datetime) -> str:
+    return json.dumps({"id": str(message_id), "timestamp": timestamp.isoformat()})
+
+
+# called by send_message before commit
+async def notify_new_message(db: AsyncSession, message: Message):
+    if REALTIME_BACKEND == "postgres":
+        # queued by Postgres and only delivered if the transaction commits
+        payload = notify_payload(message.id, message.timestamp)
+        await db.execute(select(func.pg_notify(NOTIFY_CHANNEL, payload)))
+
+
+# called by logout_service before commit
+async def notify_revocation(db: AsyncSession, key: str, exp: float):
+    if REALTIME_BACKEND == "postgres":
+        payload = json.dumps({"key": key, "exp": exp})
+        await db.execute(select(func.pg_notify(REVOKE_CHANNEL, payload)))
+
+
+# called by send_message after commit, deliveries maps recipient id -> row id
+def publish_new_message(message: Message, deliveries: dict[UUID, UUID]):
+    if REALTIME_BACKEND != "local":
+        return
+    # one hub lookup per recipient, however many users are connected
+    for recipient_id, row_id in deliveries.items():
+        if hub.is_connected(recipient_id):
+            hub.publish(
+                recipient_id,
+                _event(
+                    row_id,
+                    message.id,
+                    message.sender_id,
+                    message.subject,
+                    message.content,
+                    message.timestamp,
+                ),
+            )
+
+
+async def _deliver_notification(payload: str):
+    connected = hub.connected()
+    if not connected:
+        return
+    notification = json.loads(payload)
+    message_id = UUID(notification["id"])
+    timestamp = datetime.fromisoformat(notification["timestamp"])
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(
+                MessageRecipient.id,
+                MessageRecipient.message_id,
+                Message.sender_id,
+                Message.subject,
+                Message.content,
+                Message.timestamp,
+                MessageRecipient.recipient_id,
+            )
+            .join(MessageRecipient.message)
+            .where(
+                MessageRecipient.message_id == message_id,
+                MessageRecipient.message_timestamp == timestamp,
+                MessageRecipient.recipient_id
+                == any_(uuid_array([UUID(user_id) for user_id in connected])),
+            )
+        )
+        for *fields, recipient_id in result.all():
+            hub.publish(recipient_id, _event(*fields))
+
+
+async def listen_for_messages():
+    """Relay NOTIFYs from other workers to this worker, reconnecting."""
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    pending = set()
+
+    def on_notify(connection, pid, channel, payload):
+        task = asyncio.create_task(_deliver_notification(payload))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    def on_revoke(connection, pid, channel, payload):
+        revocation = json.loads(payload)
+        remember_revocation(revocation["key"], revocation["exp"])
+
+    while True:
+        try:
+            connection = await asyncpg.connect(dsn)
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            await connection.add_listener(NOTIFY_CHANNEL, on_notify)
+            await connection.add_listener(REVOKE_CHANNEL, on_revoke)
+            try:
+                # revocations made while the connection was down were missed
+                await load_revoked_tokens()
+                await closed.wait()
+            finally:
+                await connection.close()
+            logger.warning("LISTEN connection lost, reconnecting")
+        except (OSError, asyncpg.PostgresError, SQLAlchemyError):
+            logger.exception("LISTEN connection failed, retrying")
+        await asyncio.sleep(RECONNECT_SECONDS)
+
+
+async def sse_events(user_id: str):
+    queue = hub.subscribe(user_id)
+    try:
+        yield ": connected\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: message\ndata: {event}\n\n"
+    finally:
+        hub.unsubscribe(user_id, queue)
+
+
+async def websocket_events(websocket: WebSocket, user_id: str):
+    # subscribed before accepting so nothing sent after the handshake is missed
+    queue = hub.subscribe(user_id)
+    await websocket.accept()
+
+    async def send_events():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    sender = asyncio.create_task(send_events())
+    try:
+        # client messages are ignored, receiving only detects the disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        hub.unsubscribe(user_id, queue)
@@ -1,25 +1,55 @@
 # FastAPI routes
+from typing import Literal
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request,
+                     Response, WebSocket, status)
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import get_db
-from app.dependencies import get_current_user
-from app.schemas import (InboxMessageResponse, LoginResponse, MessageCreate,
-                         MessageRecipientResponse, MessageResponse,
-                         SentMessageResponse, UserCreate, UserResponse)
-from app.service import (create_token, create_user, get_a_messages_service,
-                         get_all_users, get_inbox_messages_service,
+from app.admission import admission_stats, admit_send
+from app.conditional import conditional_page
+from app.db import (get_db, get_read_db, get_user_read_db_by_id, pool_stats,
+                    replica_engines)
+from app.dependencies import (get_current_user, get_user_read_db,
+                              oauth2_scheme, token_cache_stats,
+                              user_id_from_token)
+from app.metrics import CONTENT_TYPE, render_metrics
+from app.pagination import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, page_response,
+                            with_next_cursor)
+from app.realtime import sse_events, websocket_events
+from app.schemas import (ConversationResponse, InboxMessageResponse,
+                         InboxMessageSummary, LoginResponse, MarkReadRequest,
+                         MessageCreate, MessageRecipientResponse,
+                         MessageResponse, MessageSearchResult,
+                         SentMessageResponse, SentMessageSummary,
+                         UnreadCountResponse, UserCreate, UserResponse)
+from app.service import (create_token, create_user, export_messages_service,
+                         get_a_messages_service, get_all_users,
+                         get_conversation_messages_service,
+                         get_conversations_service, get_inbox_messages_service,
                          get_inbox_messages_service_one_user,
                          get_sent_messages_service,
                          get_sent_messages_service_one_user,
+                         get_unread_count_service,
                          get_unread_messages_current_user_service,
-                         get_unread_messages_service, get_user,
-                         mark_message_as_read_service, send_message)
+                         get_unread_messages_service, get_user, logout_service,
+                         mark_message_as_read_service,
+                         mark_messages_as_read_service,
+                         search_messages_service, send_message,
+                         user_cache_stats)
 
 router = APIRouter()
 
+# Listing routes return page_response(): the rows their services build are
+# encoded as they are, response_model only documents their shape. Inbox,
+# unread and sent go through conditional_page() to answer If-None-Match.
+
+SUMMARY_DESCRIPTION = (
+    "Return a short snippet instead of each message's content; "
+    "GET /messages/{message_id} has the full text"
+)
+
 
 # login to get token for get current user
 @router.post("/auths/login", response_model=LoginResponse, summary="Login to get token")
@@ -27,6 +57,15 @@ async def login(user: UserCreate, db: AsyncSession = Depends(get_db)) -> LoginRe
     return await create_token(db, user)
 
 
+# logout: revoke the token used for this request
+@router.post("/auths/logout", status_code=204, summary="Revoke current token")
+async def logout(
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)
+) -> Response:
+    await logout_service(db, token)
+    return Response(status_code=204)
+
+
 # create user
 @router.post("/users", response_model=LoginResponse)
 async def create_users(
@@ -36,29 +75,48 @@ async def create_users(
 
 
 # get all users
-@router.get("/users", response_model=list[UserResponse], summary="Get all users")
+@router.get("/users", response_model=list[UserResponse], summary="List or search users")
 async def get_users(
-    db: AsyncSession = Depends(get_db),
+    response: Response,
+    q: str | None = Query(None, description="Search name or email"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_read_db),
 ) -> list[UserResponse]:
-    return await get_all_users(db)
+    return with_next_cursor(response, await get_all_users(db, limit, cursor, q))
 
 
 # get users details
 @router.get("/users/{user_id}", response_model=UserResponse, summary="Get user details")
 async def get_user_details(
-    user_id: UUID, db: AsyncSession = Depends(get_db)
+    user_id: UUID, db: AsyncSession = Depends(get_user_read_db_by_id)
 ) -> UserResponse:
     return await get_user(db, user_id)
 
 
-# send message
+# send message, once admitted (429 or 503 with Retry-After otherwise)
 @router.post("/messages", response_model=MessageResponse, summary="Send message")
 async def send_messages(
     message: MessageCreate,
     db: AsyncSession = Depends(get_db),
     current_user: str = Depends(get_current_user),
 ) -> MessageResponse:
-    return await send_message(db, sender_id=current_user, message_data=message)
+    async with admit_send(current_user, len(set(message.recipient_ids))):
+        return await send_message(db, sender_id=current_user, message_data=message)
+
+
+# Mark a batch of messages as read
+@router.put(
+    "/message-recipients/read",
+    summary="Mark messages as read by ids, sender or time",
+    response_model=list[MessageRecipientResponse],
+)
+async def mark_messages_as_read(
+    criteria: MarkReadRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: str = Depends(get_current_user),
+) -> list[MessageRecipientResponse]:
+    return await mark_messages_as_read_service(db, criteria, current_user)
 
 
 # Mark a message as read
@@ -78,82 +136,256 @@ async def mark_message_as_read(
 # View sent messages of current user
 @router.get(
     "/messages/sent",
-    response_model=list[SentMessageResponse],
+    response_model=list[SentMessageResponse | SentMessageSummary],
     summary="Get sent messages of current user",
 )
 async def get_sent_messages(
-    db: AsyncSession = Depends(get_db),
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    summary: bool = Query(False, description=SUMMARY_DESCRIPTION),
+    db: AsyncSession = Depends(get_user_read_db),
     current_user: str = Depends(get_current_user),
-) -> list[SentMessageResponse]:
-    return await get_sent_messages_service(db, current_user)
+) -> Response:
+    return await conditional_page(
+        request,
+        db,
+        current_user,
+        lambda: get_sent_messages_service(db, current_user, limit, cursor, summary),
+    )
 
 
 # View sent messages of one user
 @router.get(
     "/messages/sent/{user_id}",
-    response_model=list[SentMessageResponse],
+    response_model=list[SentMessageResponse | SentMessageSummary],
     summary="Get sent messages of one user but don't recommend because it not authorized",
     deprecated=True,
 )
 async def get_sent_messages(
+    request: Request,
     user_id: UUID,
-    db: AsyncSession = Depends(get_db),
-) -> list[SentMessageResponse]:
-    return await get_sent_messages_service_one_user(db, user_id)
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    summary: bool = Query(False, description=SUMMARY_DESCRIPTION),
+    db: AsyncSession = Depends(get_read_db),
+) -> Response:
+    return await conditional_page(
+        request,
+        db,
+        user_id,
+        lambda: get_sent_messages_service_one_user(db, user_id, limit, cursor, summary),
+    )
 
 
 # View inbox of current user
 @router.get(
     "/messages/inbox",
     summary="Get inbox messages of current user",
-    response_model=list[InboxMessageResponse],
+    response_model=list[InboxMessageResponse | InboxMessageSummary],
 )
 async def get_inbox(
-    db: AsyncSession = Depends(get_db),
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    summary: bool = Query(False, description=SUMMARY_DESCRIPTION),
+    db: AsyncSession = Depends(get_user_read_db),
     current_user: str = Depends(get_current_user),
-) -> list[InboxMessageResponse]:
-    return await get_inbox_messages_service(db, current_user)
+) -> Response:
+    return await conditional_page(
+        request,
+        db,
+        current_user,
+        lambda: get_inbox_messages_service(db, current_user, limit, cursor, summary),
+    )
 
 
 # View inbox of one user
 @router.get(
     "/messages/inbox/{user_id}",
     summary="Get inbox messages of one user but don't recommend because it not authorized",
-    response_model=list[InboxMessageResponse],
+    response_model=list[InboxMessageResponse | InboxMessageSummary],
     deprecated=True,
 )
 async def get_inbox(
+    request: Request,
     user_id: UUID,
-    db: AsyncSession = Depends(get_db),
-) -> list[InboxMessageResponse]:
-    return await get_inbox_messages_service_one_user(db, user_id)
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    summary: bool = Query(False, description=SUMMARY_DESCRIPTION),
+    db: AsyncSession = Depends(get_read_db),
+) -> Response:
+    return await conditional_page(
+        request,
+        db,
+        user_id,
+        lambda: get_inbox_messages_service_one_user(
+            db, user_id, limit, cursor, summary
+        ),
+    )
+
+
+# Unread badge count of current user
+@router.get(
+    "/messages/unread/count",
+    summary="Get number of unread messages of current user",
+    response_model=UnreadCountResponse,
+)
+async def get_unread_count(
+    db: AsyncSession = Depends(get_user_read_db),
+    current_user: UUID = Depends(get_current_user),
+) -> UnreadCountResponse:
+    return await get_unread_count_service(db, current_user)
 
 
 # View unread messages of one user
 @router.get(
     "/messages/unread/{user_id}",
     summary="Get unread messages of one user but don't recommend because it not authorized",
-    response_model=list[InboxMessageResponse],
+    response_model=list[InboxMessageResponse | InboxMessageSummary],
     deprecated=True,
 )
 async def get_unread_messages(
+    request: Request,
     user_id: UUID,
-    db: AsyncSession = Depends(get_db),
-) -> list[InboxMessageResponse]:
-    return await get_unread_messages_service(db, user_id)
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    summary: bool = Query(False, description=SUMMARY_DESCRIPTION),
+    db: AsyncSession = Depends(get_read_db),
+) -> Response:
+    return await conditional_page(
+        request,
+        db,
+        user_id,
+        lambda: get_unread_messages_service(db, user_id, limit, cursor, summary),
+    )
 
 
 # View unread messages of current user
 @router.get(
     "/messages/unread",
     summary="Get unread messages of current user",
-    response_model=list[InboxMessageResponse],
+    response_model=list[InboxMessageResponse | InboxMessageSummary],
 )
 async def get_unread_messages(
-    db: AsyncSession = Depends(get_db),
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    summary: bool = Query(False, description=SUMMARY_DESCRIPTION),
+    db: AsyncSession = Depends(get_user_read_db),
     current_user: UUID = Depends(get_current_user),
-) -> list[InboxMessageResponse]:
-    return await get_unread_messages_current_user_service(db, current_user)
+) -> Response:
+    return await conditional_page(
+        request,
+        db,
+        current_user,
+        lambda: get_unread_messages_current_user_service(
+            db, current_user, limit, cursor, summary
+        ),
+    )
+
+
+# Push new messages of current user as Server-Sent Events
+@router.get(
+    "/messages/stream",
+    summary="Stream new messages of current user (Server-Sent Events)",
+    response_class=StreamingResponse,
+)
+async def stream_messages(
+    current_user: str = Depends(get_current_user),
+) -> StreamingResponse:
+    return StreamingResponse(
+        sse_events(current_user),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Push new messages of current user over a WebSocket
+@router.websocket("/messages/stream")
+async def stream_messages_websocket(websocket: WebSocket, token: str | None = None):
+    # browsers cannot set headers on a WebSocket, so the JWT may come as ?token=
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        token = credentials
+    try:
+        current_user = user_id_from_token(token or "")
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket_events(websocket, current_user)
+
+
+# Export inbox or sent messages of current user as NDJSON
+@router.get(
+    "/messages/export",
+    summary="Stream inbox or sent messages of current user as NDJSON",
+    response_class=StreamingResponse,
+)
+async def export_messages(
+    folder: Literal["inbox", "sent"] = "inbox",
+    cursor: str | None = None,
+    current_user: str = Depends(get_current_user),
+) -> StreamingResponse:
+    return StreamingResponse(
+        export_messages_service(current_user, folder, cursor),
+        media_type="application/x-ndjson",
+    )
+
+
+# Conversations of current user, most recently active first
+@router.get(
+    "/conversations",
+    summary="Get conversations of current user by last activity",
+    response_model=list[ConversationResponse],
+)
+async def get_conversations(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_user_read_db),
+    current_user: UUID = Depends(get_current_user),
+) -> Response:
+    return page_response(
+        await get_conversations_service(db, current_user, limit, cursor)
+    )
+
+
+# Messages of one conversation visible to current user
+@router.get(
+    "/conversations/{conversation_id}/messages",
+    summary="Get messages of a conversation, newest first",
+    response_model=list[MessageResponse],
+)
+async def get_conversation_messages(
+    conversation_id: UUID,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_user_read_db),
+    current_user: UUID = Depends(get_current_user),
+) -> Response:
+    return page_response(
+        await get_conversation_messages_service(
+            db, conversation_id, current_user, limit, cursor
+        )
+    )
+
+
+# Full-text search over messages the current user sent or received
+@router.get(
+    "/messages/search",
+    summary="Search messages of current user, best match first",
+    response_model=list[MessageSearchResult],
+)
+async def search_messages(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_user_read_db),
+    current_user: UUID = Depends(get_current_user),
+) -> Response:
+    return page_response(
+        await search_messages_service(db, current_user, q, limit, cursor)
+    )
 
 
 # View a messgae with all recipients
@@ -164,7 +396,25 @@ async def get_unread_messages(
 )
 async def get_message(
     message_id: UUID,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_user_read_db),
     current_user: UUID = Depends(get_current_user),
 ) -> SentMessageResponse:
     return await get_a_messages_service(db, message_id, current_user)
+
+
+# Runtime statistics for monitoring
+@router.get("/stats", summary="Cache and connection pool statistics for monitoring")
+async def get_stats() -> dict:
+    return {
+        "token_cache": token_cache_stats(),
+        "user_cache": user_cache_stats(),
+        "send_admission": admission_stats(),
+        "pool": pool_stats(),
+        "replica_pools": [pool_stats(replica.pool) for replica in replica_engines],
+    }
+
+
+# Prometheus scrape endpoint
+@router.get("/metrics", summary="Request, database and fan-out metrics")
+async def get_metrics() -> Response:
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
@@ -1,9 +1,9 @@
 # Pydantic models
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import List, Optional
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 
 
 class UserCreate(BaseModel):
@@ -34,11 +34,14 @@ class MessageCreate(BaseModel):
     subject: Optional[str] = None
     content: str
     recipient_ids: List[UUID]  # list of user UUIDs
+    reply_to_id: Optional[UUID] = None  # continue that message's conversation
 
 
 class MessageResponse(BaseModel):
     id: UUID
     sender_id: UUID
+    conversation_id: UUID
+    reply_to_id: Optional[UUID] = None
     subject: Optional[str]
     content: str
     timestamp: datetime
@@ -58,6 +61,21 @@ class MessageRecipientResponse(BaseModel):
         from_attributes = True
 
 
+class MarkReadRequest(BaseModel):
+    ids: Optional[List[UUID]] = None  # message recipient ids
+    sender_id: Optional[UUID] = None
+    before: Optional[datetime] = None
+
+    # timestamps are stored as naive UTC, which an aware value can't be
+    # compared with
+    @field_validator("before")
+    @classmethod
+    def naive_utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        if value is not None and value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+
 class InboxMessageResponse(BaseModel):
     id: UUID
     sender_id: UUID
@@ -71,6 +89,18 @@ class InboxMessageResponse(BaseModel):
         from_attributes = True
 
 
+# summary=true listings: snippet in place of content, which
+# GET /messages/{message_id} returns in full
+class InboxMessageSummary(BaseModel):
+    id: UUID
+    sender_id: UUID
+    subject: Optional[str] = None
+    snippet: str  # the first 100 characters of content
+    timestamp: datetime
+    read: bool
+    read_at: Optional[datetime]
+
+
 class RecipientInfo(BaseModel):
     recipient_id: UUID
     read: bool
@@ -90,3 +120,40 @@ class SentMessageResponse(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class SentMessageSummary(BaseModel):
+    id: UUID
+    sender_id: UUID
+    subject: str | None
+    snippet: str
+    timestamp: datetime
+    recipients: List[RecipientInfo]
+
+
+class UnreadCountResponse(BaseModel):
+    unread_count: int
+
+
+class MessageSearchResult(BaseModel):
+    id: UUID
+    sender_id: UUID
+    subject: Optional[str] = None
+    snippet: str  # content excerpt, matched terms wrapped in <b></b>
+    timestamp: datetime
+    rank: float
+
+
+class LastMessage(BaseModel):
+    id: UUID
+    sender_id: UUID
+    subject: Optional[str] = None
+    content: str
+    timestamp: datetime
+
+
+class ConversationResponse(BaseModel):
+    id: UUID
+    participant_ids: List[UUID]  # the first 10 by id
+    last_message_at: datetime
+    last_message: LastMessage
@@ -1,24 +1,88 @@
-from datetime import datetime
-from uuid import UUID
+import json
+import os
+from datetime import datetime, timezone
+from uuid import UUID, uuid4
 
 from fastapi import HTTPException
-from sqlalchemy import and_, or_, select
+from sqlalchemy import (DateTime, Integer, and_, any_, bindparam, case, delete,
+                        exists, func, literal, or_, select, text, tuple_,
+                        union, update)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased, defer, selectinload
+from sqlalchemy.types import JSON
 
-from app.dependencies import create_access_token
-from app.models import Message, MessageRecipient, User
-from app.schemas import MessageCreate, SentMessageResponse, UserCreate
+from app.cache import LRUCache
+from app.db import copy_records, read_sessionmaker, record_write, uuid_array
+from app.dependencies import create_access_token, revoke_token
+from app.metrics import message_fanout
+from app.models import (ArchivedMessage, ArchivedMessageRecipient,
+                        Conversation, ConversationParticipant, MailboxCounter,
+                        Message, MessageRecipient, RevokedToken, User)
+from app.pagination import (decode_rank_cursor, encode_cursor,
+                            encode_rank_cursor, keyset, paginate)
+from app.realtime import (notify_new_message, notify_revocation,
+                          publish_new_message)
+from app.schemas import (MarkReadRequest, MessageCreate, UserCreate,
+                         UserResponse)
+
+# recipient lists longer than this are inserted with COPY
+BULK_SEND_THRESHOLD = int(os.getenv("BULK_SEND_THRESHOLD", "1000"))
+# rows fetched per round trip when streaming an export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+# text search configuration, must match the one in Message.search_vector
+SEARCH_CONFIG = "english"
+SNIPPET_OPTIONS = "MaxFragments=2, MinWords=5, MaxWords=20"
+# characters of content stored in messages.snippet for summary listings
+SNIPPET_LENGTH = 100
+# participant ids listed per conversation in GET /conversations
+PARTICIPANT_PREVIEW = 10
+
+# read-through user cache, users almost never change once created
+users_by_id = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+users_by_email = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+# bind a list of numbers as a single integer[] parameter
+def int_array(values: list[int]):
+    return bindparam(None, values, type_=ARRAY(Integer))
+
+
+# keep a detached snapshot of a user under both keys
+def cache_user(db_user: User) -> UserResponse:
+    user = UserResponse.model_validate(db_user)
+    users_by_id.set(str(user.id), user)
+    users_by_email.set(user.email, user)
+    return user
+
+
+def invalidate_user(user_id: UUID | None = None, email: str | None = None):
+    cached = users_by_id.pop(str(user_id)) if user_id else None
+    if cached is not None:
+        users_by_email.pop(cached.email)
+    if email:
+        cached = users_by_email.pop(email)
+        if cached is not None:
+            users_by_id.pop(str(cached.id))
+
+
+def user_cache_stats() -> dict:
+    return {"by_id": users_by_id.stats(), "by_email": users_by_email.stats()}
 
 
 # check if user exists
 async def check_user(db: AsyncSession, user: UserCreate):
-    result = await db.execute(
-        select(User).where(and_(User.email == user.email, User.name == user.name))
-    )
-    db_user = result.scalars().first()
-    if not db_user:
+    db_user = users_by_email.get(user.email)
+    if db_user is None:
+        result = await db.execute(select(User).where(User.email == user.email))
+        found = result.scalars().first()
+        db_user = cache_user(found) if found else None
+    if not db_user or db_user.name != user.name:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
@@ -39,6 +103,22 @@ async def create_token(db: AsyncSession, user: UserCreate):
         }
 
 
+# revoke a token in this worker, persist it for workers started later and
+# tell the running ones
+async def logout_service(db: AsyncSession, token: str):
+    key, exp = revoke_token(token)
+    now = datetime.utcnow()
+    expires_at = datetime.fromtimestamp(exp, timezone.utc).replace(tzinfo=None)
+    await db.execute(
+        insert(RevokedToken)
+        .values(key=key, expires_at=expires_at)
+        .on_conflict_do_nothing(index_elements=[RevokedToken.key])
+    )
+    await db.execute(delete(RevokedToken).where(RevokedToken.expires_at <= now))
+    await notify_revocation(db, key, exp)
+    await db.commit()
+
+
 # create user
 async def create_user(db: AsyncSession, user: UserCreate):
     try:
@@ -50,6 +130,8 @@ async def create_user(db: AsyncSession, user: UserCreate):
     except IntegrityError:
         await db.rollback()
         raise HTTPException(status_code=400, detail="Email already registered.")
+    invalidate_user(db_user.id, db_user.email)
+    record_write(db_user.id)
     to_token = {
         "email": db_user.email,
         "name": db_user.name,
@@ -59,51 +141,260 @@ async def create_user(db: AsyncSession, user: UserCreate):
     return {"id": db_user.id, "email": db_user.email, "token": token}
 
 
-# get all users
-async def get_all_users(db: AsyncSession):
-    result = await db.execute(select(User))
+# get all users, newest first, optionally searching name and email
+async def get_all_users(
+    db: AsyncSession,
+    limit: int,
+    cursor: str | None = None,
+    q: str | None = None,
+):
+    stmt = select(User)
+    if q:
+        # substring match (prefixes included), served by the trigram indexes
+        escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+        stmt = stmt.where(
+            or_(
+                User.name.ilike(pattern, escape="\\"),
+                User.email.ilike(pattern, escape="\\"),
+            )
+        )
+    result = await db.execute(keyset(stmt, User.created_at, User.id, cursor, limit))
     users = result.scalars().all()
-    if not users:
+    if not users and not q and not cursor:
         raise HTTPException(status_code=404, detail="Users not found")
-    return users
+    return paginate(users, limit, lambda u: (u.created_at, u.id))
 
 
 # get user details
 async def get_user(db: AsyncSession, user_id: UUID):
+    user = users_by_id.get(str(user_id))
+    if user is not None:
+        return user
     result = await db.execute(select(User).where(User.id == user_id))
     user = result.scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return cache_user(user)
+
+
+# check that every recipient exists with a single = ANY(:ids) query
+async def check_recipients(db: AsyncSession, recipient_ids: list[UUID]):
+    # recipients already in the user cache are known to exist
+    unknown = [r for r in recipient_ids if users_by_id.get(str(r)) is None]
+    if not unknown:
+        return
+    result = await db.execute(
+        select(User.id).where(User.id == any_(uuid_array(unknown)))
+    )
+    missing = set(unknown) - set(result.scalars().all())
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Recipients not found: {', '.join(sorted(map(str, missing)))}",
+        )
 
 
 # send message
 async def send_message(db: AsyncSession, sender_id: UUID, message_data: MessageCreate):
+    # drop duplicate recipients up front, keeping the caller's order
+    recipient_ids = list(dict.fromkeys(message_data.recipient_ids))
+    await check_recipients(db, recipient_ids)
     message = Message(
         sender_id=sender_id,
+        reply_to_id=message_data.reply_to_id,
         subject=message_data.subject,
         content=message_data.content,
+        snippet=message_data.content[:SNIPPET_LENGTH],
         timestamp=datetime.utcnow(),
     )
+    if message_data.reply_to_id is not None:
+        message.conversation_id = await reply_conversation(
+            db, sender_id, message_data.reply_to_id
+        )
+    else:
+        message.conversation = Conversation(id=uuid4())
     db.add(message)
     await db.flush()
-    recipients = [
-        MessageRecipient(
-            message_id=message.id,
-            recipient_id=recipient_id,
+    if len(recipient_ids) > BULK_SEND_THRESHOLD:
+        # large fan-out: COPY plain tuples instead of building ORM objects
+        deliveries = {recipient_id: uuid4() for recipient_id in recipient_ids}
+        await copy_records(
+            db,
+            MessageRecipient.__tablename__,
+            ["id", "message_id", "message_timestamp", "recipient_id", "read"],
+            [
+                (row_id, message.id, message.timestamp, recipient_id, False)
+                for recipient_id, row_id in deliveries.items()
+            ],
         )
-        for recipient_id in message_data.recipient_ids
-    ]
-    db.add_all(recipients)
+    else:
+        recipients = [
+            MessageRecipient(
+                id=uuid4(),
+                message_id=message.id,
+                message_timestamp=message.timestamp,
+                recipient_id=recipient_id,
+            )
+            for recipient_id in recipient_ids
+        ]
+        db.add_all(recipients)
+        deliveries = {r.recipient_id: r.id for r in recipients}
+    await increment_unread_counts(db, recipient_ids, sender_id)
+    await touch_conversation(db, message, [sender_id, *recipient_ids])
+    await notify_new_message(db, message)
     await db.commit()
-    await db.refresh(message)
+    # only sends that went through count towards the fan-out
+    message_fanout.observe(len(recipient_ids))
+    record_write(sender_id)
+    publish_new_message(message, deliveries)
     return message
 
 
+# conversation of the message being replied to, which only its participants
+# may reply to
+async def reply_conversation(db: AsyncSession, sender_id: UUID, reply_to_id: UUID):
+    result = await db.execute(
+        select(Message.conversation_id)
+        .join(
+            ConversationParticipant,
+            and_(
+                ConversationParticipant.conversation_id == Message.conversation_id,
+                ConversationParticipant.user_id == sender_id,
+            ),
+        )
+        .where(Message.id == reply_to_id)
+    )
+    conversation_id = result.scalar()
+    if conversation_id is None:
+        raise HTTPException(status_code=404, detail="Message to reply to not found")
+    return conversation_id
+
+
+# add the sender and recipients to the conversation and make the message their
+# latest, in the caller's transaction
+async def touch_conversation(
+    db: AsyncSession, message: Message, participant_ids: list[UUID]
+):
+    stmt = insert(ConversationParticipant).from_select(
+        ["conversation_id", "user_id", "last_message_id", "last_message_at"],
+        select(
+            literal(message.conversation_id, PG_UUID(as_uuid=True)),
+            # sorted so concurrent replies lock participant rows in one order;
+            # the sender id comes from the token as a string
+            func.unnest(uuid_array(sorted({UUID(str(u)) for u in participant_ids}))),
+            literal(message.id, PG_UUID(as_uuid=True)),
+            literal(message.timestamp, DateTime),
+        ),
+    )
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[
+                ConversationParticipant.conversation_id,
+                ConversationParticipant.user_id,
+            ],
+            set_={
+                "last_message_id": stmt.excluded.last_message_id,
+                "last_message_at": stmt.excluded.last_message_at,
+            },
+            # a send that committed late must not replace a newer message
+            where=ConversationParticipant.last_message_at
+            <= stmt.excluded.last_message_at,
+        )
+    )
+
+
+# mark unread recipient rows of current user as read in a single statement,
+# lowering the unread counter and bumping the mailbox versions of the reader
+# and of the senders, whose sent folders show the read receipts, in the same
+# round trip
+async def mark_as_read(db: AsyncSession, current_user: UUID, *criteria):
+    marked = (
+        update(MessageRecipient)
+        .where(
+            MessageRecipient.recipient_id == current_user,
+            MessageRecipient.read == False,
+            *criteria,
+        )
+        .values(read=True, read_at=datetime.utcnow())
+        .returning(
+            MessageRecipient.id,
+            MessageRecipient.message_id,
+            MessageRecipient.message_timestamp,
+            MessageRecipient.recipient_id,
+            MessageRecipient.read,
+            MessageRecipient.read_at,
+        )
+        .cte("marked")
+    )
+    mailboxes = union(
+        select(
+            literal(UUID(str(current_user)), PG_UUID(as_uuid=True)).label("user_id")
+        ).where(select(marked).exists()),
+        select(Message.sender_id).join(
+            marked,
+            and_(
+                Message.id == marked.c.message_id,
+                Message.timestamp == marked.c.message_timestamp,
+            ),
+        ),
+    ).subquery()
+    # counters locked in user id order, like sends do, before the update
+    # touches any of them; MATERIALIZED keeps the lock order of the sort
+    locked = (
+        select(MailboxCounter.user_id)
+        .join(mailboxes, MailboxCounter.user_id == mailboxes.c.user_id)
+        .order_by(MailboxCounter.user_id)
+        .with_for_update(of=MailboxCounter)
+        .cte("locked")
+        .prefix_with("MATERIALIZED")
+    )
+    bumped = (
+        update(MailboxCounter)
+        .where(MailboxCounter.user_id == locked.c.user_id)
+        .values(
+            unread_count=case(
+                (
+                    MailboxCounter.user_id == current_user,
+                    func.greatest(
+                        MailboxCounter.unread_count
+                        - select(func.count()).select_from(marked).scalar_subquery(),
+                        0,
+                    ),
+                ),
+                else_=MailboxCounter.unread_count,
+            ),
+            version=MailboxCounter.version + 1,
+        )
+        .cte("bumped")
+    )
+    result = await db.execute(
+        select(
+            marked.c.id,
+            marked.c.message_id,
+            marked.c.recipient_id,
+            marked.c.read,
+            marked.c.read_at,
+        ).add_cte(bumped)
+    )
+    rows = [dict(row) for row in result.mappings()]
+    await db.commit()
+    # nothing changed when every message was read already
+    if rows:
+        record_write(current_user)
+    return rows
+
+
 # mark message as read
 async def mark_message_as_read_service(
     db: AsyncSession, messagerecipient_id: UUID, current_user: UUID
 ):
+    rows = await mark_as_read(
+        db, current_user, MessageRecipient.id == messagerecipient_id
+    )
+    if rows:
+        return rows[0]
+    # already read (or not ours): return the row as it is
     result = await db.execute(
         select(MessageRecipient).where(
             and_(
@@ -117,208 +408,587 @@ async def mark_message_as_read_service(
         raise HTTPException(
             status_code=404, detail="Message not found or you are not the recipient"
         )
-    message.read = True
-    message.read_at = datetime.utcnow()
-    await db.commit()
-    await db.refresh(message)
     return message
 
 
+# mark a batch of messages as read
+async def mark_messages_as_read_service(
+    db: AsyncSession, criteria: MarkReadRequest, current_user: UUID
+):
+    conditions = []
+    if criteria.ids is not None:
+        conditions.append(MessageRecipient.id == any_(uuid_array(criteria.ids)))
+    if criteria.sender_id is not None:
+        conditions += [
+            MessageRecipient.message_id == Message.id,
+            MessageRecipient.message_timestamp == Message.timestamp,
+            Message.sender_id == criteria.sender_id,
+        ]
+    if criteria.before is not None:
+        # the recipient row's copy of the timestamp prunes its partitions
+        conditions.append(MessageRecipient.message_timestamp < criteria.before)
+    if not conditions:
+        raise HTTPException(
+            status_code=400, detail="Provide ids, sender_id or before to mark as read"
+        )
+    return await mark_as_read(db, current_user, *conditions)
+
+
+# bump unread counters of recipients and the mailbox versions of everyone the
+# send shows up for, in the caller's transaction
+async def increment_unread_counts(
+    db: AsyncSession, recipient_ids: list[UUID], sender_id: UUID | None = None
+):
+    increments = dict.fromkeys(recipient_ids, 1)
+    if sender_id is not None:
+        # the sender id comes from the token as a string
+        increments.setdefault(UUID(str(sender_id)), 0)
+    if not increments:
+        return
+    # one array parameter however many recipients; sorted so concurrent sends
+    # lock counter rows in the same order
+    user_ids = sorted(increments)
+    stmt = insert(MailboxCounter).from_select(
+        ["user_id", "unread_count", "version"],
+        select(
+            func.unnest(uuid_array(user_ids)),
+            func.unnest(int_array([increments[u] for u in user_ids])),
+            literal(1),
+        ),
+    )
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[MailboxCounter.user_id],
+            set_={
+                "unread_count": MailboxCounter.unread_count
+                + stmt.excluded.unread_count,
+                "version": MailboxCounter.version + 1,
+            },
+        )
+    )
+
+
+# lower unread counters by the given amounts and bump the version of every
+# mailbox given, in the caller's transaction
+async def decrement_unread_counts(db: AsyncSession, decrements: dict[UUID, int]):
+    user_ids = sorted(decrements)
+    # lock counters in user id order, like sends do, before changing them
+    await db.execute(
+        select(MailboxCounter.user_id)
+        .where(MailboxCounter.user_id == any_(uuid_array(user_ids)))
+        .order_by(MailboxCounter.user_id)
+        .with_for_update()
+    )
+    changes = select(
+        func.unnest(uuid_array(user_ids)).label("user_id"),
+        func.unnest(int_array([decrements[u] for u in user_ids])).label("unread"),
+    ).subquery()
+    await db.execute(
+        update(MailboxCounter)
+        .where(MailboxCounter.user_id == changes.c.user_id)
+        .values(
+            unread_count=func.greatest(
+                MailboxCounter.unread_count - changes.c.unread, 0
+            ),
+            version=MailboxCounter.version + 1,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+# version of a user's mailbox, 0 until anything was sent to or by them
+async def get_mailbox_version(db: AsyncSession, user_id: UUID) -> int:
+    result = await db.execute(
+        select(MailboxCounter.version).where(MailboxCounter.user_id == user_id)
+    )
+    return result.scalar() or 0
+
+
+# unread badge count of current user
+async def get_unread_count_service(db: AsyncSession, current_user: UUID):
+    result = await db.execute(
+        select(MailboxCounter.unread_count).where(
+            MailboxCounter.user_id == current_user
+        )
+    )
+    return {"unread_count": result.scalar() or 0}
+
+
+# rebuild unread counters from message_recipients, returns rows corrected
+async def reconcile_unread_counts(db: AsyncSession) -> int:
+    # block concurrent increments/decrements until the rebuild commits
+    await db.execute(text("LOCK TABLE mailbox_counters IN EXCLUSIVE MODE"))
+    unread_recipients = select(MessageRecipient.recipient_id).where(
+        MessageRecipient.read == False
+    )
+    zeroed = await db.execute(
+        update(MailboxCounter)
+        .where(
+            MailboxCounter.unread_count != 0,
+            MailboxCounter.user_id.not_in(unread_recipients),
+        )
+        .values(unread_count=0)
+    )
+    stmt = insert(MailboxCounter).from_select(
+        ["user_id", "unread_count"],
+        select(MessageRecipient.recipient_id, func.count())
+        .where(MessageRecipient.read == False)
+        .group_by(MessageRecipient.recipient_id),
+    )
+    rebuilt = await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[MailboxCounter.user_id],
+            set_={"unread_count": stmt.excluded.unread_count},
+            where=MailboxCounter.unread_count != stmt.excluded.unread_count,
+        )
+    )
+    await db.commit()
+    return zeroed.rowcount + rebuilt.rowcount
+
+
+# recipients of a page of messages in one query. Instead of a selectinload,
+# which matches (message_id, message_timestamp) pairs one by one in every
+# partition, the ids go in one array and the page's time range picks the
+# partitions to search.
+async def recipients_by_message(
+    db: AsyncSession, messages: list[Message]
+) -> dict[UUID, list[dict]]:
+    if not messages:
+        return {}
+    timestamps = [message.timestamp for message in messages]
+    result = await db.execute(
+        select(
+            MessageRecipient.message_id,
+            MessageRecipient.recipient_id,
+            MessageRecipient.read,
+            MessageRecipient.read_at,
+        ).where(
+            MessageRecipient.message_id
+            == any_(uuid_array([message.id for message in messages])),
+            MessageRecipient.message_timestamp.between(
+                min(timestamps), max(timestamps)
+            ),
+        )
+    )
+    recipients = {}
+    for message_id, *fields in result:
+        recipients.setdefault(message_id, []).append(
+            dict(zip(("recipient_id", "read", "read_at"), fields))
+        )
+    return recipients
+
+
+# a sent folder entry, with content or with only its snippet in summary mode
+def sent_entry(message: Message, recipients: list[dict], summary: bool) -> dict:
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "subject": message.subject,
+        **({"snippet": message.snippet} if summary else {"content": message.content}),
+        "timestamp": message.timestamp,
+        "recipients": recipients,
+    }
+
+
 # View sent messages of current user
-async def get_sent_messages_service(db: AsyncSession, current_user: UUID):
-    # Query all messages sent by the current user
+async def get_sent_messages_service(
+    db: AsyncSession,
+    current_user: UUID,
+    limit: int,
+    cursor: str | None = None,
+    summary: bool = False,
+):
+    # Query all messages sent by the current user, loading only the text the
+    # listing returns
     result = await db.execute(
-        select(Message)
-        .options(selectinload(Message.recipients))
-        .where(Message.sender_id == current_user)
-        .order_by(Message.timestamp.desc())
+        keyset(
+            select(Message)
+            .options(defer(Message.content if summary else Message.snippet))
+            .where(Message.sender_id == current_user),
+            Message.timestamp,
+            Message.id,
+            cursor,
+            limit,
+        )
     )
 
     sent_messages = result.scalars().all()
+    recipients = await recipients_by_message(db, sent_messages)
 
-    # Convert ORM models to Pydantic models
+    # plain dicts, encoded as they are by the route
     response = []
     for message in sent_messages:
-        recipients = [
-            {
-                "recipient_id": recipient.recipient_id,
-                "read": recipient.read,
-                "read_at": recipient.read_at,
-            }
-            for recipient in message.recipients
-        ]
-        response.append(
-            SentMessageResponse(
-                id=message.id,
-                sender_id=message.sender_id,
-                subject=message.subject,
-                content=message.content,
-                timestamp=message.timestamp,
-                recipients=recipients,
-            )
-        )
+        response.append(sent_entry(message, recipients.get(message.id, []), summary))
 
-    return response
+    return paginate(response, limit, lambda m: (m["timestamp"], m["id"]))
 
 
 # View sent messages of one user
-async def get_sent_messages_service_one_user(db: AsyncSession, user_id: UUID):
+async def get_sent_messages_service_one_user(
+    db: AsyncSession,
+    user_id: UUID,
+    limit: int,
+    cursor: str | None = None,
+    summary: bool = False,
+):
     result = await db.execute(
-        select(Message)
-        .options(selectinload(Message.recipients))
-        .where(Message.sender_id == user_id)
-        .order_by(Message.timestamp.desc())
+        keyset(
+            select(Message)
+            .options(defer(Message.content if summary else Message.snippet))
+            .where(Message.sender_id == user_id),
+            Message.timestamp,
+            Message.id,
+            cursor,
+            limit,
+        )
     )
     sent_messages = result.scalars().all()
+    recipients = await recipients_by_message(db, sent_messages)
     response = []
     for message in sent_messages:
-        recipients = [
-            {
-                "recipient_id": recipient.recipient_id,
-                "read": recipient.read,
-                "read_at": recipient.read_at,
-            }
-            for recipient in message.recipients
-        ]
-        response.append(
-            SentMessageResponse(
-                id=message.id,
-                sender_id=message.sender_id,
-                subject=message.subject,
-                content=message.content,
-                timestamp=message.timestamp,
-                recipients=recipients,
-            )
-        )
+        response.append(sent_entry(message, recipients.get(message.id, []), summary))
 
-    return response
+    return paginate(response, limit, lambda m: (m["timestamp"], m["id"]))
+
+
+# one row per (message, recipient) projected straight from the join, so the
+# cost does not depend on how many other recipients a message has. The page
+# is cut from message_recipients alone, newest first along its partition
+# key, so only the newest partitions are read before it is joined to
+# messages; joining first leaves the planner unable to estimate the join and
+# sorting the whole mailbox.
+def inbox_rows(
+    id_column,
+    recipient_id: UUID,
+    cursor: str | None,
+    limit: int | None,
+    *criteria,
+    summary: bool = False,
+):
+    page = keyset(
+        select(MessageRecipient).where(
+            MessageRecipient.recipient_id == recipient_id, *criteria
+        ),
+        MessageRecipient.message_timestamp,
+        id_column,
+        cursor,
+        limit,
+    ).subquery()
+    page_id = page.c[id_column.key]
+    return (
+        select(
+            page_id.label("id"),
+            Message.sender_id,
+            Message.subject,
+            Message.snippet if summary else Message.content,
+            Message.timestamp,
+            page.c.read,
+            page.c.read_at,
+        )
+        .select_from(page)
+        .join(
+            Message,
+            and_(
+                Message.id == page.c.message_id,
+                Message.timestamp == page.c.message_timestamp,
+            ),
+        )
+        .order_by(page.c.message_timestamp.desc(), page_id.desc())
+    )
 
 
 # View inbox messages of current user
-async def get_inbox_messages_service(db: AsyncSession, current_user: UUID):
+async def get_inbox_messages_service(
+    db: AsyncSession,
+    current_user: UUID,
+    limit: int,
+    cursor: str | None = None,
+    summary: bool = False,
+):
     result = await db.execute(
-        select(Message)
-        .join(Message.recipients)
-        .options(selectinload(Message.recipients))
-        .where(MessageRecipient.recipient_id == current_user)
-        .order_by(Message.timestamp.desc())
-    )
-
-    datas = result.scalars().all()
-    messages = []
-    for data in datas:
-        for recipient in data.recipients:
-            if str(recipient.recipient_id) == current_user:
-                messages.append(
-                    {
-                        "id": recipient.id,
-                        "sender_id": data.sender_id,
-                        "subject": data.subject,
-                        "content": data.content,
-                        "timestamp": data.timestamp,
-                        "read": recipient.read,
-                        "read_at": recipient.read_at,
-                    }
-                )
-                break
-    return messages
+        inbox_rows(MessageRecipient.id, current_user, cursor, limit, summary=summary)
+    )
+    messages = [dict(row) for row in result.mappings()]
+    return paginate(messages, limit, lambda m: (m["timestamp"], m["id"]))
 
 
 # View inbox messages of one user
-async def get_inbox_messages_service_one_user(db: AsyncSession, user_id: UUID):
+async def get_inbox_messages_service_one_user(
+    db: AsyncSession,
+    user_id: UUID,
+    limit: int,
+    cursor: str | None = None,
+    summary: bool = False,
+):
     result = await db.execute(
-        select(Message)
-        .join(Message.recipients)
-        .options(selectinload(Message.recipients))
-        .where(MessageRecipient.recipient_id == user_id)
-        .order_by(Message.timestamp.desc())
-    )
-
-    datas = result.scalars().all()
-    messages = []
-    for data in datas:
-        for recipient in data.recipients:
-            if str(recipient.recipient_id) == str(user_id):
-                messages.append(
-                    {
-                        "id": recipient.id,
-                        "sender_id": data.sender_id,
-                        "subject": data.subject,
-                        "content": data.content,
-                        "timestamp": data.timestamp,
-                        "read": recipient.read,
-                        "read_at": recipient.read_at,
-                    }
-                )
-                break
-    return messages
+        inbox_rows(MessageRecipient.id, user_id, cursor, limit, summary=summary)
+    )
+    messages = [dict(row) for row in result.mappings()]
+    return paginate(messages, limit, lambda m: (m["timestamp"], m["id"]))
 
 
 # View unread messages of one user
-async def get_unread_messages_service(db: AsyncSession, user_id: UUID):
-
+async def get_unread_messages_service(
+    db: AsyncSession,
+    user_id: UUID,
+    limit: int,
+    cursor: str | None = None,
+    summary: bool = False,
+):
     result = await db.execute(
-        select(Message)
-        .join(Message.recipients)
-        .options(selectinload(Message.recipients))
-        .where(MessageRecipient.recipient_id == user_id, MessageRecipient.read == False)
-        .order_by(Message.timestamp.desc())
-    )
-
-    datas = result.scalars().all()
-    messages = []
-    for data in datas:
-        for recipient in data.recipients:
-            if str(recipient.recipient_id) == str(user_id):
-                messages.append(
-                    {
-                        "id": data.id,
-                        "sender_id": data.sender_id,
-                        "subject": data.subject,
-                        "content": data.content,
-                        "timestamp": data.timestamp,
-                        "read": recipient.read,
-                        "read_at": recipient.read_at,
-                    }
-                )
-                break
-    return messages
+        inbox_rows(
+            MessageRecipient.message_id,
+            user_id,
+            cursor,
+            limit,
+            MessageRecipient.read == False,
+            summary=summary,
+        )
+    )
+    messages = [dict(row) for row in result.mappings()]
+    return paginate(messages, limit, lambda m: (m["timestamp"], m["id"]))
 
 
 # View unread messages of current user
 async def get_unread_messages_current_user_service(
-    db: AsyncSession, current_user: UUID
+    db: AsyncSession,
+    current_user: UUID,
+    limit: int,
+    cursor: str | None = None,
+    summary: bool = False,
 ):
-
     result = await db.execute(
-        select(Message)
-        .join(Message.recipients)
-        .options(selectinload(Message.recipients))
-        .where(
-            MessageRecipient.recipient_id == current_user,
+        inbox_rows(
+            MessageRecipient.message_id,
+            current_user,
+            cursor,
+            limit,
             MessageRecipient.read == False,
+            summary=summary,
+        )
+    )
+    messages = [dict(row) for row in result.mappings()]
+    return paginate(messages, limit, lambda m: (m["timestamp"], m["id"]))
+
+
+# sent message rows with their recipients aggregated in the database
+def sent_rows(sender_id: UUID):
+    recipients = (
+        select(
+            func.json_agg(
+                func.json_build_object(
+                    "recipient_id",
+                    MessageRecipient.recipient_id,
+                    "read",
+                    MessageRecipient.read,
+                    "read_at",
+                    MessageRecipient.read_at,
+                ),
+                type_=JSON,
+            )
         )
-        .order_by(Message.timestamp.desc())
-    )
-
-    datas = result.scalars().all()
-    messages = []
-    for data in datas:
-        for recipient in data.recipients:
-            if str(recipient.recipient_id) == str(current_user):
-                messages.append(
-                    {
-                        "id": data.id,
-                        "sender_id": data.sender_id,
-                        "subject": data.subject,
-                        "content": data.content,
-                        "timestamp": data.timestamp,
-                        "read": recipient.read,
-                        "read_at": recipient.read_at,
-                    }
-                )
-                break
-    return messages
+        .where(
+            MessageRecipient.message_id == Message.id,
+            MessageRecipient.message_timestamp == Message.timestamp,
+        )
+        .scalar_subquery()
+    )
+    return select(
+        Message.id,
+        Message.sender_id,
+        Message.subject,
+        Message.content,
+        Message.timestamp,
+        recipients.label("recipients"),
+    ).where(Message.sender_id == sender_id)
+
+
+# Conversations of current user, most recently active first. Reads one
+# participant row per conversation plus its latest message.
+async def get_conversations_service(
+    db: AsyncSession,
+    current_user: UUID,
+    limit: int,
+    cursor: str | None = None,
+):
+    others = aliased(ConversationParticipant)
+    # a bounded preview, broadcast threads can have thousands of participants
+    preview = (
+        select(others.user_id)
+        .where(others.conversation_id == ConversationParticipant.conversation_id)
+        .order_by(others.user_id)
+        .limit(PARTICIPANT_PREVIEW)
+        .correlate(ConversationParticipant)
+        .subquery()
+    )
+    participant_ids = select(func.array_agg(preview.c.user_id)).scalar_subquery()
+    result = await db.execute(
+        keyset(
+            select(
+                ConversationParticipant.conversation_id.label("id"),
+                participant_ids.label("participant_ids"),
+                ConversationParticipant.last_message_at,
+                Message.id.label("message_id"),
+                Message.sender_id,
+                Message.subject,
+                Message.content,
+                Message.timestamp,
+            )
+            .join(
+                Message,
+                and_(
+                    Message.id == ConversationParticipant.last_message_id,
+                    Message.timestamp == ConversationParticipant.last_message_at,
+                ),
+            )
+            .where(ConversationParticipant.user_id == current_user),
+            ConversationParticipant.last_message_at,
+            ConversationParticipant.conversation_id,
+            cursor,
+            limit,
+        )
+    )
+    conversations = [
+        {
+            "id": row.id,
+            "participant_ids": row.participant_ids,
+            "last_message_at": row.last_message_at,
+            "last_message": {
+                "id": row.message_id,
+                "sender_id": row.sender_id,
+                "subject": row.subject,
+                "content": row.content,
+                "timestamp": row.timestamp,
+            },
+        }
+        for row in result
+    ]
+    return paginate(conversations, limit, lambda c: (c["last_message_at"], c["id"]))
+
+
+# Messages of a conversation the current user sent or received, newest first
+async def get_conversation_messages_service(
+    db: AsyncSession,
+    conversation_id: UUID,
+    current_user: UUID,
+    limit: int,
+    cursor: str | None = None,
+):
+    received = exists().where(
+        MessageRecipient.message_id == Message.id,
+        MessageRecipient.message_timestamp == Message.timestamp,
+        MessageRecipient.recipient_id == current_user,
+    )
+    result = await db.execute(
+        keyset(
+            select(
+                Message.id,
+                Message.sender_id,
+                Message.conversation_id,
+                Message.reply_to_id,
+                Message.subject,
+                Message.content,
+                Message.timestamp,
+            ).where(
+                Message.conversation_id == conversation_id,
+                or_(Message.sender_id == current_user, received),
+            ),
+            Message.timestamp,
+            Message.id,
+            cursor,
+            limit,
+        )
+    )
+    messages = [dict(row) for row in result.mappings()]
+    # every participant sees at least the message that made them one
+    if not messages and not cursor:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return paginate(messages, limit, lambda m: (m["timestamp"], m["id"]))
+
+
+# Search subject and content of messages the current user sent or received,
+# best match first
+async def search_messages_service(
+    db: AsyncSession,
+    current_user: UUID,
+    q: str,
+    limit: int,
+    cursor: str | None = None,
+):
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    rank = func.ts_rank(Message.search_vector, query)
+    # the user's message keys, each branch driven by its own index
+    mine = union(
+        select(Message.id, Message.timestamp).where(Message.sender_id == current_user),
+        select(MessageRecipient.message_id, MessageRecipient.message_timestamp).where(
+            MessageRecipient.recipient_id == current_user
+        ),
+    ).subquery()
+    matches = (
+        select(
+            Message.id,
+            Message.sender_id,
+            Message.subject,
+            Message.content,
+            Message.timestamp,
+            rank.label("rank"),
+        )
+        .join(
+            mine, and_(mine.c.id == Message.id, mine.c.timestamp == Message.timestamp)
+        )
+        .where(Message.search_vector.op("@@")(query))
+    )
+    if cursor:
+        after_rank, after_id = decode_rank_cursor(cursor)
+        matches = matches.where(tuple_(rank, Message.id) < tuple_(after_rank, after_id))
+    page = matches.order_by(rank.desc(), Message.id.desc()).limit(limit + 1).subquery()
+    # snippets are costly, so they are only built for the rows on the page
+    result = await db.execute(
+        select(
+            page.c.id,
+            page.c.sender_id,
+            page.c.subject,
+            func.ts_headline(
+                SEARCH_CONFIG, page.c.content, query, SNIPPET_OPTIONS
+            ).label("snippet"),
+            page.c.timestamp,
+            page.c.rank,
+        ).order_by(page.c.rank.desc(), page.c.id.desc())
+    )
+    rows = [dict(row) for row in result.mappings()]
+    return paginate(rows, limit, lambda m: (m["rank"], m["id"]), encode_rank_cursor)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+# Export inbox or sent messages of current user as NDJSON, newest first.
+# The cursor is checked before streaming starts so a bad one is still a 400.
+def export_messages_service(current_user: UUID, folder: str, cursor: str | None):
+    if folder == "sent":
+        stmt = keyset(
+            sent_rows(current_user), Message.timestamp, Message.id, cursor, None
+        )
+    else:
+        stmt = inbox_rows(MessageRecipient.id, current_user, cursor, None)
+    return _stream_ndjson(stmt, read_sessionmaker(current_user))
+
+
+async def _stream_ndjson(stmt, session_factory):
+    # own session: the response outlives the request's dependencies
+    async with session_factory() as db:
+        # server-side cursor, only EXPORT_BATCH_SIZE rows held at a time
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for rows in result.mappings().partitions():
+            lines = []
+            for row in rows:
+                # every line carries the cursor to resume the export after it
+                item = dict(row, cursor=encode_cursor(row["timestamp"], row["id"]))
+                lines.append(json.dumps(item, default=_json_default) + "\n")
+            yield "".join(lines)
 
 
 # View a specific message
@@ -336,9 +1006,28 @@ async def get_a_messages_service(db, message_id, current_user):
         )
     )
     message = result.scalars().first()
+    if not message:
+        message = await get_archived_message(db, message_id, current_user)
     if not message:
         raise HTTPException(
             status_code=404,
             detail="Message not found or you are not authorized to view it",
         )
     return message
+
+
+# a message past the retention period, with the same access rule
+async def get_archived_message(db, message_id, current_user):
+    result = await db.execute(
+        select(ArchivedMessage)
+        .join(ArchivedMessage.recipients)
+        .options(selectinload(ArchivedMessage.recipients))
+        .where(
+            ArchivedMessage.id == message_id,
+            or_(
+                ArchivedMessage.sender_id == current_user,
+                ArchivedMessageRecipient.recipient_id == current_user,
+            ),
+        )
+    )
+    return result.scalars().first()
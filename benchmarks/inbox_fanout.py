@@ -0,0 +1,131 @@
+# Benchmark: inbox read cost versus message fan-out
+#
+# Seeds one reader per fan-out level whose inbox holds a page of messages,
+# each broadcast to FANOUT recipients, then times one inbox page. The inbox
+# query projects one row per (message, reader), so the timings should stay
+# flat as fan-out grows.
+#
+#   PYTHONPATH=. python benchmarks/inbox_fanout.py
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import delete, select
+
+from app.db import AsyncSessionLocal, copy_records
+from app.models import Conversation, Message, User
+from app.partitions import create_partitions
+from app.service import SNIPPET_LENGTH, get_inbox_messages_service
+
+FANOUTS = [1, 10, 100, 1000, 5000]
+PAGE_SIZE = 50
+ROUNDS = 20
+EMAIL_PREFIX = "bench-fanout-"
+
+
+async def seed(db, fanout: int, others: list) -> str:
+    reader_id = uuid4()
+    now = datetime.utcnow()
+    await copy_records(
+        db,
+        "users",
+        ["id", "email", "name", "created_at"],
+        [(reader_id, f"{EMAIL_PREFIX}{reader_id}@example.com", "Reader", now)],
+    )
+    messages, recipients = [], []
+    for i in range(PAGE_SIZE):
+        message_id = uuid4()
+        timestamp = now - timedelta(seconds=i)
+        # a conversation per message, sharing its id
+        messages.append(
+            (
+                message_id,
+                message_id,
+                others[0],
+                "Broadcast",
+                "x" * 200,
+                "x" * SNIPPET_LENGTH,
+                timestamp,
+            )
+        )
+        recipients.append((uuid4(), message_id, timestamp, reader_id, False))
+        recipients.extend(
+            (uuid4(), message_id, timestamp, user_id, False)
+            for user_id in others[: fanout - 1]
+        )
+    await copy_records(
+        db,
+        "conversations",
+        ["id", "created_at"],
+        [(message[0], message[-1]) for message in messages],
+    )
+    await copy_records(
+        db,
+        "messages",
+        [
+            "id",
+            "conversation_id",
+            "sender_id",
+            "subject",
+            "content",
+            "snippet",
+            "timestamp",
+        ],
+        messages,
+    )
+    await copy_records(
+        db,
+        "message_recipients",
+        ["id", "message_id", "message_timestamp", "recipient_id", "read"],
+        recipients,
+    )
+    return str(reader_id)
+
+
+async def main():
+    async with AsyncSessionLocal() as db:
+        # clears earlier runs (their conversations, then the users, which
+        # cascade to messages) and opens the transaction the COPYs below join
+        await db.execute(
+            delete(Conversation).where(
+                Conversation.id.in_(
+                    select(Message.conversation_id)
+                    .join(User, User.id == Message.sender_id)
+                    .where(User.email.like(f"{EMAIL_PREFIX}%"))
+                )
+            )
+        )
+        await db.execute(delete(User).where(User.email.like(f"{EMAIL_PREFIX}%")))
+        others = [uuid4() for _ in range(max(FANOUTS))]
+        now = datetime.utcnow()
+        await create_partitions(db, now - timedelta(seconds=PAGE_SIZE), now)
+        await copy_records(
+            db,
+            "users",
+            ["id", "email", "name", "created_at"],
+            [
+                (user_id, f"{EMAIL_PREFIX}{user_id}@example.com", "Other", now)
+                for user_id in others
+            ],
+        )
+        readers = {fanout: await seed(db, fanout, others) for fanout in FANOUTS}
+        await db.commit()
+
+    print(f"{'fan-out':>8} {'median ms':>10} {'p95 ms':>8}")
+    for fanout, reader_id in readers.items():
+        timings = []
+        async with AsyncSessionLocal() as db:
+            for _ in range(ROUNDS):
+                start = time.perf_counter()
+                page, _ = await get_inbox_messages_service(db, reader_id, PAGE_SIZE)
+                timings.append((time.perf_counter() - start) * 1000)
+                assert len(page) == PAGE_SIZE
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        print(f"{fanout:>8} {statistics.median(timings):>10.2f} {p95:>8.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,334 @@
+# Load benchmark: seeded mailboxes driven through the ASGI app
+#
+# Seeds BENCH_USERS users and BENCH_MESSAGES messages with COPY, using a
+# skewed fan-out (mostly direct messages, a tail of broadcasts), older mail
+# mostly read and every message starting its own conversation. Then each
+# scenario fires BENCH_REQUESTS requests at the real app through
+# BENCH_CONCURRENCY concurrent clients and reports
+# throughput and latency percentiles. Exits non-zero when a scenario has
+# errors or is slower than benchmarks/baselines.json by more than
+# BENCH_TOLERANCE; --update-baselines records the current run instead.
+#
+#   DB_ECHO=false PYTHONPATH=. python benchmarks/load.py [--update-baselines]
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from uuid import uuid4
+
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import delete, select
+
+from app.db import AsyncSessionLocal, copy_records
+from app.dependencies import create_access_token
+from app.main import app
+from app.models import Conversation, Message, User
+from app.partitions import create_partitions
+from app.service import SNIPPET_LENGTH
+
+USERS = int(os.getenv("BENCH_USERS", "2000"))
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "20000"))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "500"))
+# keep below the pool size plus overflow or requests queue for connections
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "10"))
+# allowed slowdown against the baseline, 0.5 = 50%
+TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "0.5"))
+# unmeasured requests first, to fill the pool and prepared statement caches
+WARMUP = int(os.getenv("BENCH_WARMUP", "100"))
+SEED = int(os.getenv("BENCH_SEED", "42"))
+BASELINES = Path(__file__).with_name("baselines.json")
+EMAIL_PREFIX = "bench-load-"
+
+# (probability, smallest, largest) recipients per message
+FANOUT_DISTRIBUTION = [(0.70, 1, 1), (0.25, 2, 10), (0.04, 11, 100), (0.01, 101, 1000)]
+READ_RATIO = 0.7
+HISTORY_DAYS = 90
+
+
+def fanout(rng: random.Random) -> int:
+    weights = [p for p, _, _ in FANOUT_DISTRIBUTION]
+    _, low, high = rng.choices(FANOUT_DISTRIBUTION, weights)[0]
+    return min(rng.randint(low, high), USERS - 1)
+
+
+async def seed(rng: random.Random) -> dict:
+    """Bulk load the synthetic mailboxes, returning ids the scenarios use."""
+    now = datetime.utcnow()
+    user_ids = [uuid4() for _ in range(USERS)]
+    messages, recipients, participants, unread = [], [], [], []
+    for i in range(MESSAGES):
+        message_id = uuid4()
+        sender_id = rng.choice(user_ids)
+        timestamp = now - timedelta(seconds=rng.randint(0, HISTORY_DAYS * 86400))
+        content = "x" * rng.randint(20, 400)
+        # a conversation per message, sharing its id
+        messages.append(
+            (
+                message_id,
+                message_id,
+                sender_id,
+                f"Subject {i}",
+                content,
+                content[:SNIPPET_LENGTH],
+                timestamp,
+            )
+        )
+        # one spare candidate so the sender can be dropped without going short
+        candidates = rng.sample(user_ids, fanout(rng) + 1)
+        recipient_ids = [u for u in candidates if u != sender_id][: len(candidates) - 1]
+        participants.extend(
+            (message_id, user_id, message_id, timestamp)
+            for user_id in {sender_id, *recipient_ids}
+        )
+        for recipient_id in recipient_ids:
+            row_id = uuid4()
+            read = rng.random() < READ_RATIO
+            read_at = (
+                timestamp + timedelta(minutes=rng.randint(1, 600)) if read else None
+            )
+            recipients.append(
+                (row_id, message_id, timestamp, recipient_id, read, read_at)
+            )
+            if not read:
+                unread.append((recipient_id, row_id))
+
+    async with AsyncSessionLocal() as db:
+        # clears earlier runs (their conversations, then the users, which
+        # cascade to messages) and opens the transaction the COPYs below join
+        await db.execute(
+            delete(Conversation).where(
+                Conversation.id.in_(
+                    select(Message.conversation_id)
+                    .join(User, User.id == Message.sender_id)
+                    .where(User.email.like(f"{EMAIL_PREFIX}%"))
+                )
+            )
+        )
+        await db.execute(delete(User).where(User.email.like(f"{EMAIL_PREFIX}%")))
+        await create_partitions(db, now - timedelta(days=HISTORY_DAYS), now)
+        await copy_records(
+            db,
+            "users",
+            ["id", "email", "name", "created_at"],
+            [
+                (user_id, f"{EMAIL_PREFIX}{user_id}@example.com", f"User {i}", now)
+                for i, user_id in enumerate(user_ids)
+            ],
+        )
+        await copy_records(
+            db,
+            "conversations",
+            ["id", "created_at"],
+            [(message[0], message[-1]) for message in messages],
+        )
+        await copy_records(
+            db,
+            "messages",
+            [
+                "id",
+                "conversation_id",
+                "sender_id",
+                "subject",
+                "content",
+                "snippet",
+                "timestamp",
+            ],
+            messages,
+        )
+        await copy_records(
+            db,
+            "message_recipients",
+            [
+                "id",
+                "message_id",
+                "message_timestamp",
+                "recipient_id",
+                "read",
+                "read_at",
+            ],
+            recipients,
+        )
+        await copy_records(
+            db,
+            "conversation_participants",
+            ["conversation_id", "user_id", "last_message_id", "last_message_at"],
+            participants,
+        )
+        await copy_records(
+            db,
+            "mailbox_counters",
+            ["user_id", "unread_count"],
+            list(Counter(recipient_id for recipient_id, _ in unread).items()),
+        )
+        await db.commit()
+
+    rng.shuffle(unread)
+    print(
+        f"seeded {USERS} users, {MESSAGES} messages, {len(recipients)} deliveries "
+        f"({len(unread)} unread)"
+    )
+    return {"user_ids": user_ids, "unread": unread}
+
+
+def auth(user_id) -> dict:
+    token = create_access_token(
+        {
+            "email": f"{EMAIL_PREFIX}{user_id}@example.com",
+            "name": "User",
+            "id": str(user_id),
+        }
+    )
+    return {"Authorization": f"Bearer {token}"}
+
+
+def scenarios(rng: random.Random, seeded: dict) -> dict:
+    """Build each scenario's requests up front as (method, url, kwargs)."""
+    user_ids = seeded["user_ids"]
+    headers = {user_id: auth(user_id) for user_id in user_ids}
+
+    def reads(url):
+        return [
+            ("GET", url, {"headers": headers[rng.choice(user_ids)]})
+            for _ in range(REQUESTS)
+        ]
+
+    sends = []
+    for _ in range(REQUESTS):
+        sender_id = rng.choice(user_ids)
+        recipient_ids = rng.sample(user_ids, fanout(rng))
+        sends.append(
+            (
+                "POST",
+                "/messages",
+                {
+                    "headers": headers[sender_id],
+                    "json": {
+                        "subject": "Load test",
+                        "content": "Hello from the load benchmark",
+                        "recipient_ids": [str(r) for r in recipient_ids],
+                    },
+                },
+            )
+        )
+
+    mark_reads = [
+        ("PUT", f"/message-recipients/{row_id}/read", {"headers": headers[reader_id]})
+        for reader_id, row_id in seeded["unread"][:REQUESTS]
+    ]
+    return {
+        "inbox": reads("/messages/inbox"),
+        "unread": reads("/messages/unread"),
+        "sent": reads("/messages/sent"),
+        "conversations": reads("/conversations"),
+        "send": sends,
+        "mark_read": mark_reads,
+    }
+
+
+def percentile(timings: list[float], pct: float) -> float:
+    # nearest-rank on sorted timings
+    return timings[max(0, min(len(timings) - 1, round(pct / 100 * len(timings)) - 1))]
+
+
+async def run(client: AsyncClient, requests: list) -> dict:
+    queue = list(reversed(requests))
+    timings, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            method, url, kwargs = queue.pop()
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            timings.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - start
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "errors": errors,
+        "throughput_rps": round(len(timings) / elapsed, 1),
+        "p50_ms": round(percentile(timings, 50), 2),
+        "p95_ms": round(percentile(timings, 95), 2),
+        "p99_ms": round(percentile(timings, 99), 2),
+    }
+
+
+def regressions(name: str, result: dict, baseline: dict | None) -> list[str]:
+    problems = []
+    if result["errors"]:
+        problems.append(f"{name}: {result['errors']} failed requests")
+    if baseline is None:
+        return problems
+    if result["p95_ms"] > baseline["p95_ms"] * (1 + TOLERANCE):
+        problems.append(
+            f"{name}: p95 {result['p95_ms']} ms vs baseline {baseline['p95_ms']} ms"
+        )
+    if result["throughput_rps"] < baseline["throughput_rps"] / (1 + TOLERANCE):
+        problems.append(
+            f"{name}: {result['throughput_rps']} req/s vs baseline "
+            f"{baseline['throughput_rps']} req/s"
+        )
+    return problems
+
+
+async def main(update_baselines: bool) -> int:
+    rng = random.Random(SEED)
+    seeded = await seed(rng)
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+
+    results, problems = {}, []
+    print(
+        f"{'scenario':<13} {'requests':>8} {'errors':>6} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://bench") as client:
+        plans = scenarios(rng, seeded)
+        await run(
+            client,
+            [
+                plans[name][i % REQUESTS]
+                for name in ("inbox", "unread", "sent", "conversations")
+                for i in range(WARMUP)
+            ],
+        )
+        for name, requests in plans.items():
+            result = results[name] = await run(client, requests)
+            print(
+                f"{name:<13} {result['requests']:>8} {result['errors']:>6} "
+                f"{result['throughput_rps']:>8} {result['p50_ms']:>8} "
+                f"{result['p95_ms']:>8} {result['p99_ms']:>8}"
+            )
+            problems += regressions(name, result, baselines.get(name))
+
+    if update_baselines:
+        BASELINES.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"baselines written to {BASELINES}")
+        return 0
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load benchmark against seeded mailboxes"
+    )
+    parser.add_argument(
+        "--update-baselines",
+        action="store_true",
+        help="record this run as the new baselines instead of comparing",
+    )
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.update_baselines)))
@@ -0,0 +1,123 @@
+# Benchmark: response encoding cost per item of a 1,000-item listing page
+#
+# Compares the two ways a listing route can turn its service's rows into a
+# response body, without a database:
+#
+#   validated  FastAPI validating the rows against the route's response_model
+#              and dumping them with pydantic (the sent folder also built
+#              SentMessageResponse objects first, as the service used to)
+#   orjson     page_response(): the rows encoded as they are
+#
+# Both must produce the same bytes, which the benchmark checks before timing.
+#
+#   PYTHONPATH=. python benchmarks/serialization.py
+import asyncio
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from asyncpg.pgproto.pgproto import UUID
+from fastapi.routing import serialize_response
+
+from app.pagination import page_response
+from app.routes import router
+from app.schemas import SentMessageResponse
+
+PAGE_SIZE = 1000
+ROUNDS = 20
+
+
+# ids as asyncpg returns them
+def row_id() -> UUID:
+    return UUID(uuid4().bytes)
+
+
+def inbox_rows(now: datetime) -> list[dict]:
+    return [
+        {
+            "id": row_id(),
+            "sender_id": row_id(),
+            "subject": f"Subject {i}",
+            "content": "x" * 200,
+            "timestamp": now - timedelta(seconds=i),
+            "read": i % 3 == 0,
+            "read_at": now if i % 3 == 0 else None,
+        }
+        for i in range(PAGE_SIZE)
+    ]
+
+
+def sent_rows(now: datetime) -> list[dict]:
+    return [
+        {
+            "id": row_id(),
+            "sender_id": row_id(),
+            "subject": f"Subject {i}",
+            "content": "x" * 200,
+            "timestamp": now - timedelta(seconds=i),
+            "recipients": [
+                {"recipient_id": row_id(), "read": False, "read_at": None}
+                for _ in range(3)
+            ],
+        }
+        for i in range(PAGE_SIZE)
+    ]
+
+
+def conversation_rows(now: datetime) -> list[dict]:
+    return [
+        {
+            "id": row_id(),
+            "participant_ids": [row_id() for _ in range(3)],
+            "last_message_at": now - timedelta(seconds=i),
+            "last_message": {
+                "id": row_id(),
+                "sender_id": row_id(),
+                "subject": f"Subject {i}",
+                "content": "x" * 200,
+                "timestamp": now - timedelta(seconds=i),
+            },
+        }
+        for i in range(PAGE_SIZE)
+    ]
+
+
+async def per_item_us(encode) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await encode()
+    return (time.perf_counter() - start) / ROUNDS / PAGE_SIZE * 1e6
+
+
+async def main():
+    fields = {
+        route.path: route.response_field
+        for route in router.routes
+        if hasattr(route, "response_field")
+    }
+    now = datetime.utcnow()
+    cases = [
+        ("/messages/inbox", inbox_rows(now), None),
+        ("/messages/sent", sent_rows(now), SentMessageResponse),
+        ("/conversations", conversation_rows(now), None),
+    ]
+    print(f"{'route':<16} {'validated us':>13} {'orjson us':>10} {'speedup':>8}")
+    for path, rows, model in cases:
+
+        async def validated():
+            content = [model(**row) for row in rows] if model else rows
+            return await serialize_response(
+                field=fields[path], response_content=content, dump_json=True
+            )
+
+        async def orjson():
+            return page_response((rows, None)).body
+
+        assert await validated() == await orjson(), path
+        before = await per_item_us(validated)
+        after = await per_item_us(orjson)
+        print(f"{path:<16} {before:>13.2f} {after:>10.2f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,6 +6,8 @@ from dotenv import load_dotenv
 from sqlalchemy import engine_from_config, pool
 
 from app.db import Base
+from app.models import OPTIONAL_INDEXES
+from app.partitions import PARTITION_NAME
 
 load_dotenv()
 
@@ -32,6 +34,20 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 target_metadata = Base.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    # monthly partitions are created at runtime by app/partitions.py, and
+    # Postgres adds a foreign key to each partition of a referenced table
+    if reflected and type_ == "table":
+        return not PARTITION_NAME.match(name)
+    if reflected and type_ == "foreign_key_constraint":
+        return not PARTITION_NAME.match(object.referred_table.name)
+    # trigram indexes exist only where pg_trgm is available
+    if reflected and type_ == "index":
+        return name not in OPTIONAL_INDEXES
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -56,6 +72,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -76,7 +93,11 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
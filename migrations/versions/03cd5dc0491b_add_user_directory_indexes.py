@@ -0,0 +1,67 @@
+"""Add user directory indexes
+
+Revision ID: 03cd5dc0491b
+Revises: 2915ab5b1c93
+Create Date: 2026-10-18 17:05:12.418305
+
+"""
+
+import logging
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "03cd5dc0491b"
+down_revision: Union[str, None] = "2915ab5b1c93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    has_trgm = bind.execute(
+        sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    ).scalar()
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_created_at_id",
+            "users",
+            [sa.literal_column("created_at DESC"), sa.literal_column("id DESC")],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        if not has_trgm:
+            # search still works without them, as a sequential scan
+            logger.warning("pg_trgm is not available, skipping trigram indexes")
+            return
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.create_index(
+            "ix_users_name_trgm",
+            "users",
+            ["name"],
+            unique=False,
+            postgresql_concurrently=True,
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        )
+        op.create_index(
+            "ix_users_email_trgm",
+            "users",
+            ["email"],
+            unique=False,
+            postgresql_concurrently=True,
+            postgresql_using="gin",
+            postgresql_ops={"email": "gin_trgm_ops"},
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_users_email_trgm", table_name="users", if_exists=True)
+    op.drop_index("ix_users_name_trgm", table_name="users", if_exists=True)
+    op.drop_index("ix_users_created_at_id", table_name="users")
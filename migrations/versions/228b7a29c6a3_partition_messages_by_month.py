@@ -0,0 +1,253 @@
+"""partition messages by month
+
+Revision ID: 228b7a29c6a3
+Revises: 6d3c41262a74
+Create Date: 2026-10-18 17:29:41.331312
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "228b7a29c6a3"
+down_revision: Union[str, None] = "6d3c41262a74"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# months created past the current one, the default of PARTITION_MONTHS_AHEAD
+MONTHS_AHEAD = 1
+MESSAGE_COLUMNS = (
+    "id, sender_id, conversation_id, reply_to_id, subject, content, timestamp"
+)
+RECIPIENT_COLUMNS = "id, message_id, recipient_id, read, read_at"
+
+
+def _create_tables(suffix: str, partitioned: bool):
+    message_key = ["id", "timestamp"] if partitioned else ["id"]
+    recipient_key = ["id", "message_timestamp"] if partitioned else ["id"]
+    op.create_table(
+        f"messages{suffix}",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("sender_id", sa.UUID(), nullable=False),
+        sa.Column("conversation_id", sa.UUID(), nullable=False),
+        sa.Column("reply_to_id", sa.UUID(), nullable=True),
+        sa.Column("subject", sa.String(), nullable=True),
+        sa.Column("content", sa.Text(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=not partitioned),
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed(
+                "setweight(to_tsvector('english', coalesce(subject, '')), 'A') || setweight(to_tsvector('english', content), 'B')",
+                persisted=True,
+            ),
+            nullable=True,
+        ),
+        sa.PrimaryKeyConstraint(*message_key, name=f"messages{suffix}_pkey"),
+        postgresql_partition_by="RANGE (timestamp)" if partitioned else None,
+    )
+    op.create_table(
+        f"message_recipients{suffix}",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("message_id", sa.UUID(), nullable=False),
+        *(
+            [sa.Column("message_timestamp", sa.DateTime(), nullable=False)]
+            if partitioned
+            else []
+        ),
+        sa.Column("recipient_id", sa.UUID(), nullable=False),
+        sa.Column("read", sa.Boolean(), nullable=True),
+        sa.Column("read_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint(
+            *recipient_key, name=f"message_recipients{suffix}_pkey"
+        ),
+        postgresql_partition_by="RANGE (message_timestamp)" if partitioned else None,
+    )
+
+
+# swap the copies in under the original names, then add the constraints and
+# indexes the originals had; plain CREATE INDEX because CONCURRENTLY is not
+# supported on partitioned tables, and the tables are new anyway
+def _replace_tables(suffix: str, partitioned: bool):
+    op.drop_table("message_recipients")
+    op.drop_table("messages")
+    for table in ("messages", "message_recipients"):
+        op.rename_table(f"{table}{suffix}", table)
+        op.execute(
+            f"ALTER TABLE {table} RENAME CONSTRAINT {table}{suffix}_pkey "
+            f"TO {table}_pkey"
+        )
+    op.create_foreign_key(
+        "messages_sender_id_fkey",
+        "messages",
+        "users",
+        ["sender_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.create_foreign_key(
+        "messages_conversation_id_fkey",
+        "messages",
+        "conversations",
+        ["conversation_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.create_foreign_key(
+        "message_recipients_message_id_fkey",
+        "message_recipients",
+        "messages",
+        ["message_id", "message_timestamp"] if partitioned else ["message_id"],
+        ["id", "timestamp"] if partitioned else ["id"],
+        ondelete="CASCADE",
+    )
+    op.create_foreign_key(
+        "message_recipients_recipient_id_fkey",
+        "message_recipients",
+        "users",
+        ["recipient_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.create_index(
+        "ix_messages_sender_id_timestamp",
+        "messages",
+        [
+            "sender_id",
+            sa.literal_column("timestamp DESC"),
+            sa.literal_column("id DESC"),
+        ],
+    )
+    op.create_index(
+        "ix_messages_conversation_id_timestamp",
+        "messages",
+        [
+            "conversation_id",
+            sa.literal_column("timestamp DESC"),
+            sa.literal_column("id DESC"),
+        ],
+    )
+    op.create_index(
+        "ix_messages_search_vector",
+        "messages",
+        ["search_vector"],
+        postgresql_using="gin",
+    )
+    op.create_index(
+        "ix_message_recipients_message_id", "message_recipients", ["message_id"]
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Copies messages and message_recipients into monthly partitioned tables
+    # inside this migration's transaction: both tables are locked until it
+    # commits, so run it in a maintenance window.
+    _create_tables("_partitioned", partitioned=True)
+    bind = op.get_bind()
+    months = bind.execute(sa.text(f"""
+            SELECT generate_series(
+                date_trunc('month', least(min(timestamp), now() AT TIME ZONE 'utc')),
+                date_trunc('month', greatest(
+                    max(timestamp),
+                    now() AT TIME ZONE 'utc' + interval '{MONTHS_AHEAD} months'
+                )),
+                interval '1 month'
+            )
+            FROM messages
+            """)).scalars().all()
+    for month in months:
+        bounds = (
+            f"FROM ('{month:%Y-%m-%d}') TO ('{month:%Y-%m-%d}'::timestamp "
+            "+ interval '1 month')"
+        )
+        for table in ("messages", "message_recipients"):
+            op.execute(
+                f"CREATE TABLE {table}_p{month:%Y_%m} PARTITION OF "
+                f"{table}_partitioned FOR VALUES {bounds}"
+            )
+    op.execute(f"""
+        INSERT INTO messages_partitioned ({MESSAGE_COLUMNS})
+        SELECT id, sender_id, conversation_id, reply_to_id, subject, content,
+            coalesce(timestamp, now() AT TIME ZONE 'utc')
+        FROM messages
+        """)
+    op.execute(f"""
+        INSERT INTO message_recipients_partitioned
+            ({RECIPIENT_COLUMNS}, message_timestamp)
+        SELECT r.id, r.message_id, r.recipient_id, r.read, r.read_at, m.timestamp
+        FROM message_recipients r JOIN messages_partitioned m ON m.id = r.message_id
+        """)
+    _replace_tables("_partitioned", partitioned=True)
+    op.create_index(
+        "ix_message_recipients_recipient_id_timestamp",
+        "message_recipients",
+        [
+            "recipient_id",
+            sa.literal_column("message_timestamp DESC"),
+            sa.literal_column("id DESC"),
+        ],
+    )
+    op.create_index(
+        "ix_message_recipients_unread",
+        "message_recipients",
+        [
+            "recipient_id",
+            sa.literal_column("message_timestamp DESC"),
+            sa.literal_column("message_id DESC"),
+        ],
+        postgresql_where=sa.text("read = false"),
+    )
+    op.execute("ANALYZE messages, message_recipients")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    _create_tables("_unpartitioned", partitioned=False)
+    op.execute(f"""
+        INSERT INTO messages_unpartitioned ({MESSAGE_COLUMNS})
+        SELECT {MESSAGE_COLUMNS} FROM messages
+        """)
+    op.execute(f"""
+        INSERT INTO message_recipients_unpartitioned ({RECIPIENT_COLUMNS})
+        SELECT {RECIPIENT_COLUMNS} FROM message_recipients
+        """)
+    # replies may have outlived their parent while there was no foreign key
+    op.execute("""
+        UPDATE messages_unpartitioned reply SET reply_to_id = NULL
+        WHERE reply_to_id IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM messages_unpartitioned parent
+            WHERE parent.id = reply.reply_to_id
+        )
+        """)
+    # dropping the partitioned parents drops their partitions
+    _replace_tables("_unpartitioned", partitioned=False)
+    op.create_foreign_key(
+        "messages_reply_to_id_fkey",
+        "messages",
+        "messages",
+        ["reply_to_id"],
+        ["id"],
+        ondelete="SET NULL",
+    )
+    op.create_index(
+        "ix_messages_reply_to_id",
+        "messages",
+        ["reply_to_id"],
+        postgresql_where=sa.text("reply_to_id IS NOT NULL"),
+    )
+    op.create_index(
+        "ix_message_recipients_recipient_id_message_id",
+        "message_recipients",
+        ["recipient_id", "message_id"],
+    )
+    op.create_index(
+        "ix_message_recipients_unread",
+        "message_recipients",
+        ["recipient_id", "message_id"],
+        postgresql_where=sa.text("read = false"),
+    )
@@ -0,0 +1,35 @@
+# Shared test helpers
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from app.db import engine
+from app.metrics import QueryStats
+
+
+@pytest.fixture
+def count_queries():
+    """Count the SQL statements run on the primary inside a with-block.
+
+    with count_queries() as queries:
+        await client.get("/messages/inbox", headers=headers)
+    assert queries.count == 1
+    """
+
+    @contextmanager
+    def counting():
+        stats = QueryStats()
+
+        def after_cursor_execute(*args):
+            stats.count += 1
+
+        event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+        try:
+            yield stats
+        finally:
+            event.remove(
+                engine.sync_engine, "after_cursor_execute", after_cursor_execute
+            )
+
+    return counting
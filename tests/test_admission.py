@@ -0,0 +1,101 @@
+# Test admission control on the send path: rate limit and concurrency cap
+import asyncio
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+from httpx import ASGITransport, AsyncClient
+
+from app import admission
+from app.admission import admit_send
+from app.main import app
+
+
+@pytest.mark.asyncio
+async def test_sends_are_rate_limited_per_user_by_recipients(monkeypatch):
+    monkeypatch.setattr(admission, "SEND_RATE", 0.5)
+    monkeypatch.setattr(admission, "SEND_BURST", 3)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        sender, other, *recipients = [
+            (
+                await client.post(
+                    "/users",
+                    json={"email": f"admission-{uuid4()}@example.com", "name": "A"},
+                )
+            ).json()
+            for _ in range(4)
+        ]
+
+        async def send(user, to):
+            return await client.post(
+                "/messages",
+                json={"content": "Hi", "recipient_ids": [r["id"] for r in to]},
+                headers={"Authorization": f"Bearer {user['token']}"},
+            )
+
+        # the burst covers two recipients, then one; the next recipient has
+        # to wait for the bucket to refill
+        assert (await send(sender, recipients)).status_code == 200
+        assert (await send(sender, recipients[:1])).status_code == 200
+        limited = await send(sender, recipients[:1])
+        assert limited.status_code == 429
+        assert limited.headers["Retry-After"] == "2"
+        # other users keep their own budget
+        assert (await send(other, recipients)).status_code == 200
+
+        metrics = (await client.get("/metrics")).text
+        assert 'sends_throttled_total{reason="rate_limited"}' in metrics
+
+
+@pytest.mark.asyncio
+async def test_sends_past_the_cap_queue_then_are_shed(monkeypatch):
+    monkeypatch.setattr(admission, "SEND_RATE", 1)
+    monkeypatch.setattr(admission, "SEND_BURST", 2)
+    monkeypatch.setattr(admission, "SEND_CONCURRENCY", 1)
+    monkeypatch.setattr(admission, "SEND_QUEUE_SIZE", 1)
+    monkeypatch.setattr(admission, "SEND_QUEUE_TIMEOUT", 0.2)
+    # recreated on first use with the patched SEND_CONCURRENCY
+    monkeypatch.setattr(admission, "_send_slots", None)
+
+    release = asyncio.Event()
+
+    async def hold_slot():
+        async with admit_send("holder", 1):
+            await release.wait()
+
+    async def queued_send():
+        async with admit_send("queued", 1):
+            return "sent"
+
+    holder = asyncio.create_task(hold_slot())
+    await asyncio.sleep(0)
+    assert admission.admission_stats()["running"] == 1
+
+    # the queue has room for one waiter, which gets the slot once it's free
+    waiter = asyncio.create_task(queued_send())
+    await asyncio.sleep(0)
+    assert admission.admission_stats()["queued"] == 1
+    with pytest.raises(HTTPException) as full:
+        async with admit_send("shed", 1):
+            pass
+    assert full.value.status_code == 503
+    # the shed send was refunded: its user's bucket is full again
+    assert admission.take_tokens("shed", 2) == 0
+    release.set()
+    assert await waiter == "sent"
+    await holder
+
+    # a waiter that doesn't get a slot in time is shed too
+    release.clear()
+    holder = asyncio.create_task(hold_slot())
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as timed_out:
+        async with admit_send("late", 1):
+            pass
+    assert timed_out.value.status_code == 503
+    assert timed_out.value.headers["Retry-After"] == "1"
+    assert admission.take_tokens("late", 2) == 0
+    release.set()
+    await holder
+    assert admission.admission_stats()["running"] == 0
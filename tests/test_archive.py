@@ -0,0 +1,100 @@
+# Test archiving messages past the retention period
+from datetime import datetime
+from uuid import UUID, uuid4
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app.archive import archive_messages
+from app.db import AsyncSessionLocal
+from app.main import app
+from app.models import Conversation, Message, MessageRecipient
+from app.partitions import create_partitions
+from app.service import increment_unread_counts
+
+
+@pytest.mark.asyncio
+async def test_archived_message_is_still_readable():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        sender, recipient, stranger = [
+            (
+                await client.post(
+                    "/users",
+                    json={
+                        "email": f"archive-{name}-{uuid4()}@example.com",
+                        "name": name,
+                    },
+                )
+            ).json()
+            for name in ("sender", "recipient", "stranger")
+        ]
+        headers = {"Authorization": f"Bearer {recipient['token']}"}
+        sender_headers = {"Authorization": f"Bearer {sender['token']}"}
+        send_resp = await client.post(
+            "/messages",
+            json={"content": "Current", "recipient_ids": [recipient["id"]]},
+            headers=sender_headers,
+        )
+        assert send_resp.status_code == 200
+
+        # an unread message from long before the retention period
+        sent_at = datetime(2001, 12, 5)
+        async with AsyncSessionLocal() as db:
+            await create_partitions(db, sent_at, sent_at)
+            conversation = Conversation(id=uuid4())
+            old = Message(
+                id=uuid4(),
+                sender_id=UUID(sender["id"]),
+                conversation_id=conversation.id,
+                content="Expired",
+                snippet="Expired",
+                timestamp=sent_at,
+            )
+            db.add_all([conversation, old])
+            await db.flush()
+            db.add(
+                MessageRecipient(
+                    message_id=old.id,
+                    message_timestamp=sent_at,
+                    recipient_id=UUID(recipient["id"]),
+                )
+            )
+            await increment_unread_counts(db, [UUID(recipient["id"])])
+            await db.commit()
+        count_resp = await client.get("/messages/unread/count", headers=headers)
+        assert count_resp.json()["unread_count"] == 2
+        sent_resp = await client.get("/messages/sent", headers=sender_headers)
+        assert len(sent_resp.json()) == 2
+
+        retention_days = (datetime.utcnow() - datetime(2002, 1, 2)).days
+        archived, dropped = await archive_messages(retention_days, batch_size=1)
+        assert archived == 1
+        assert dropped == ["message_recipients_p2001_12", "messages_p2001_12"]
+
+        inbox = (await client.get("/messages/inbox", headers=headers)).json()
+        assert [m["content"] for m in inbox] == ["Current"]
+        count_resp = await client.get("/messages/unread/count", headers=headers)
+        assert count_resp.json()["unread_count"] == 1
+        # the sender's sent folder lost the message too
+        resent_resp = await client.get(
+            "/messages/sent",
+            headers={**sender_headers, "If-None-Match": sent_resp.headers["ETag"]},
+        )
+        assert resent_resp.status_code == 200
+        assert [m["content"] for m in resent_resp.json()] == ["Current"]
+
+        # GET /messages/{id} falls back to the archive, with the same access rule
+        message_resp = await client.get(f"/messages/{old.id}", headers=headers)
+        assert message_resp.status_code == 200
+        message = message_resp.json()
+        assert message["content"] == "Expired"
+        assert message["timestamp"] == sent_at.isoformat()
+        assert message["recipients"] == [
+            {"recipient_id": recipient["id"], "read": False, "read_at": None}
+        ]
+        stranger_resp = await client.get(
+            f"/messages/{old.id}",
+            headers={"Authorization": f"Bearer {stranger['token']}"},
+        )
+        assert stranger_resp.status_code == 404
@@ -0,0 +1,75 @@
+# Test in-process caches: LRU, token verification and users
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+
+from app.cache import LRUCache
+from app.dependencies import (create_access_token, revoke_token, token_cache,
+                              token_cache_stats, user_id_from_token)
+from app.models import User
+from app.service import (cache_user, invalidate_user, users_by_email,
+                         users_by_id)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(maxsize=10, ttl=60)
+    cache.set("expired", 1, expires_at=time.time() - 1)
+    cache.set("fresh", 2)
+    assert cache.get("expired") is None
+    assert cache.get("fresh") == 2
+    assert len(cache) == 1
+
+
+def test_token_is_verified_once_then_served_from_cache():
+    token = create_access_token({"id": "user-1"})
+    hits = token_cache.hits
+    assert user_id_from_token(token) == "user-1"
+    assert user_id_from_token(token) == "user-1"
+    assert token_cache.hits == hits + 1
+
+
+def test_revoked_token_is_rejected():
+    token = create_access_token({"id": "user-2"})
+    assert user_id_from_token(token) == "user-2"
+    revoke_token(token)
+    with pytest.raises(HTTPException) as exc:
+        user_id_from_token(token)
+    assert exc.value.status_code == 401
+    assert token_cache_stats()["revoked"] >= 1
+    # other tokens of the same user stay valid
+    assert user_id_from_token(create_access_token({"id": "user-2"})) == "user-2"
+
+
+def test_user_cache_invalidation_clears_both_keys():
+    user = cache_user(
+        User(
+            id=uuid4(),
+            email="cached@example.com",
+            name="C",
+            created_at=datetime.utcnow(),
+        )
+    )
+    assert users_by_id.get(str(user.id)) == user
+    assert users_by_email.get("cached@example.com") == user
+    invalidate_user(email="cached@example.com")
+    assert users_by_id.get(str(user.id)) is None
+    assert users_by_email.get("cached@example.com") is None
@@ -1,14 +1,20 @@
 # Test message-related functionality
-from datetime import datetime
+import json
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 
 import pytest
 from httpx import ASGITransport, AsyncClient
+from pydantic import TypeAdapter
 
+from app import service
 from app.main import app
+from app.pagination import encode_cursor
+from app.schemas import InboxMessageResponse, SentMessageResponse
 
 
-@pytest.mark.asyncio
-async def test_message_flow():
+@pytest.mark.asyncio(loop_scope="module")
+async def test_message_flow(count_queries):
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as client:
 
@@ -85,6 +91,13 @@ async def test_message_flow():
         assert any(m["content"] == "Test message content" for m in unread_messages)
         assert any(m["read"] == False for m in unread_messages)
 
+        # Unread badge count (GET /messages/unread/count)
+        count_resp = await client.get(
+            "/messages/unread/count", headers=headers_recipient
+        )
+        assert count_resp.status_code == 200
+        assert count_resp.json()["unread_count"] == 1
+
         # Mark message recipient as read (PUT /message-recipients/{id}/read)
         read_resp = await client.put(
             f"/message-recipients/{inbox_messages_id}/read", headers=headers_recipient
@@ -95,6 +108,11 @@ async def test_message_flow():
         assert read_message["read"] == True
         assert read_message["read_at"] is not None
 
+        count_resp = await client.get(
+            "/messages/unread/count", headers=headers_recipient
+        )
+        assert count_resp.json()["unread_count"] == 0
+
         # Get a specific message (GET /messages/{id})
         specific_message_resp = await client.get(
             f"/messages/{message_id}", headers=headers
@@ -104,3 +122,447 @@ async def test_message_flow():
         assert specific_message["subject"] == "Test Subject"
         assert specific_message["content"] == "Test message content"
         assert specific_message["id"] == message_id
+
+        # Page through the inbox one message at a time (GET /messages/inbox?limit=)
+        second_payload = {
+            "subject": "Second Subject",
+            "content": "Second message content",
+            "recipient_ids": [recipient["id"]],
+        }
+        second_resp = await client.post(
+            "/messages", json=second_payload, headers=headers
+        )
+        assert second_resp.status_code == 200
+
+        first_page_resp = await client.get(
+            "/messages/inbox", params={"limit": 1}, headers=headers_recipient
+        )
+        assert first_page_resp.status_code == 200
+        first_page = first_page_resp.json()
+        assert len(first_page) == 1
+        assert first_page[0]["subject"] == "Second Subject"
+        next_cursor = first_page_resp.headers["X-Next-Cursor"]
+
+        second_page_resp = await client.get(
+            "/messages/inbox",
+            params={"limit": 1, "cursor": next_cursor},
+            headers=headers_recipient,
+        )
+        assert second_page_resp.status_code == 200
+        second_page = second_page_resp.json()
+        assert len(second_page) == 1
+        assert second_page[0]["subject"] == "Test Subject"
+        assert "X-Next-Cursor" not in second_page_resp.headers
+
+        bad_cursor_resp = await client.get(
+            "/messages/inbox", params={"cursor": "not-a-cursor"}, headers=headers
+        )
+        assert bad_cursor_resp.status_code == 400
+
+        # a cursor rewritten with an aware timestamp names the same position
+        cursor_row = first_page[0]
+        aware_cursor = encode_cursor(
+            datetime.fromisoformat(cursor_row["timestamp"])
+            .replace(tzinfo=timezone.utc)
+            .astimezone(timezone(timedelta(hours=2))),
+            cursor_row["id"],
+        )
+        aware_page_resp = await client.get(
+            "/messages/inbox",
+            params={"limit": 1, "cursor": aware_cursor},
+            headers=headers_recipient,
+        )
+        assert aware_page_resp.status_code == 200
+        assert aware_page_resp.json() == second_page
+
+        # Mark everything from the sender as read (PUT /message-recipients/read)
+        bulk_read_resp = await client.put(
+            "/message-recipients/read",
+            json={"sender_id": sender["id"]},
+            headers=headers_recipient,
+        )
+        assert bulk_read_resp.status_code == 200
+        bulk_read = bulk_read_resp.json()
+        assert [m["id"] for m in bulk_read] == [first_page[0]["id"]]
+        assert all(m["read"] for m in bulk_read)
+
+        count_resp = await client.get(
+            "/messages/unread/count", headers=headers_recipient
+        )
+        assert count_resp.json()["unread_count"] == 0
+
+        # Marking an already read message again keeps its original read_at
+        reread_resp = await client.put(
+            f"/message-recipients/{inbox_messages_id}/read", headers=headers_recipient
+        )
+        assert reread_resp.status_code == 200
+        assert reread_resp.json()["read_at"] == read_message["read_at"]
+
+        empty_bulk_resp = await client.put(
+            "/message-recipients/read", json={}, headers=headers_recipient
+        )
+        assert empty_bulk_resp.status_code == 400
+
+        # an aware cutoff is compared as UTC with the stored naive timestamps
+        aware_bulk_resp = await client.put(
+            "/message-recipients/read",
+            json={"before": "2000-01-01T02:00:00+02:00"},
+            headers=headers_recipient,
+        )
+        assert aware_bulk_resp.status_code == 200
+        assert aware_bulk_resp.json() == []
+
+        # Duplicate recipients are delivered once, unknown recipients are rejected
+        dup_resp = await client.post(
+            "/messages",
+            json={"content": "Duplicate", "recipient_ids": [recipient["id"]] * 2},
+            headers=headers,
+        )
+        assert dup_resp.status_code == 200
+        latest_sent = (await client.get("/messages/sent", headers=headers)).json()[0]
+        assert latest_sent["id"] == dup_resp.json()["id"]
+        assert len(latest_sent["recipients"]) == 1
+
+        unknown_resp = await client.post(
+            "/messages",
+            json={"content": "Nobody", "recipient_ids": [sender["id"], str(uuid4())]},
+            headers=headers,
+        )
+        assert unknown_resp.status_code == 404
+
+        # Export the inbox as NDJSON and resume after the first line
+        export_resp = await client.get(
+            "/messages/export", params={"folder": "inbox"}, headers=headers_recipient
+        )
+        assert export_resp.status_code == 200
+        assert export_resp.headers["content-type"].startswith("application/x-ndjson")
+        exported = [json.loads(line) for line in export_resp.text.splitlines()]
+        assert len(exported) == 3
+        assert exported[-1]["subject"] == "Test Subject"
+
+        resumed_resp = await client.get(
+            "/messages/export",
+            params={"folder": "inbox", "cursor": exported[0]["cursor"]},
+            headers=headers_recipient,
+        )
+        resumed = [json.loads(line) for line in resumed_resp.text.splitlines()]
+        assert [m["id"] for m in resumed] == [m["id"] for m in exported[1:]]
+
+        sent_export_resp = await client.get(
+            "/messages/export", params={"folder": "sent"}, headers=headers
+        )
+        sent_exported = [
+            json.loads(line) for line in sent_export_resp.text.splitlines()
+        ]
+        assert sent_exported[-1]["id"] == message_id
+        assert sent_exported[-1]["recipients"][0]["recipient_id"] == recipient["id"]
+
+        # Listings run a fixed number of statements however many rows they return:
+        # the mailbox version for their ETag, then the page
+        with count_queries() as queries:
+            inbox_resp = await client.get("/messages/inbox", headers=headers_recipient)
+        assert len(inbox_resp.json()) == 3
+        assert queries.count == 2
+        with count_queries() as queries:
+            await client.get("/messages/unread/count", headers=headers_recipient)
+        assert queries.count == 1
+        with count_queries() as queries:
+            sent_resp = await client.get("/messages/sent", headers=headers)
+        # the messages, then all of their recipients in one query
+        assert queries.count == 3
+
+        # Listings are encoded straight from the rows, byte for byte what their
+        # response models would produce
+        for resp, model in (
+            (inbox_resp, InboxMessageResponse),
+            (sent_resp, SentMessageResponse),
+        ):
+            adapter = TypeAdapter(list[model])
+            assert (
+                adapter.dump_json(adapter.validate_json(resp.content)) == resp.content
+            )
+
+        # An unchanged mailbox answers If-None-Match after the version lookup
+        inbox_etag = inbox_resp.headers["ETag"]
+        with count_queries() as queries:
+            not_modified = await client.get(
+                "/messages/inbox",
+                headers={**headers_recipient, "If-None-Match": inbox_etag},
+            )
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        assert not_modified.headers["ETag"] == inbox_etag
+        assert queries.count == 1
+        summary_resp = await client.get(
+            "/messages/inbox",
+            params={"summary": True},
+            headers={**headers_recipient, "If-None-Match": inbox_etag},
+        )
+        assert summary_resp.status_code == 200
+
+        # Reading a message changes the reader's listings and the sender's, whose
+        # sent folder shows the read receipt
+        unread_resp = await client.get("/messages/unread", headers=headers_recipient)
+        [unread] = [m for m in inbox_resp.json() if not m["read"]]
+        read_resp = await client.put(
+            f"/message-recipients/{unread['id']}/read", headers=headers_recipient
+        )
+        assert read_resp.status_code == 200
+        for url, resp, user_headers in (
+            ("/messages/inbox", inbox_resp, headers_recipient),
+            ("/messages/unread", unread_resp, headers_recipient),
+            ("/messages/sent", sent_resp, headers),
+        ):
+            etag = resp.headers["ETag"]
+            changed = await client.get(
+                url, headers={**user_headers, "If-None-Match": etag}
+            )
+            assert changed.status_code == 200, url
+            assert changed.headers["ETag"] != etag
+
+        # Summary listings carry a fixed-length snippet instead of the content
+        long_content = "word " * 100
+        long_resp = await client.post(
+            "/messages",
+            json={"content": long_content, "recipient_ids": [recipient["id"]]},
+            headers=headers,
+        )
+        inbox_summary = (
+            await client.get(
+                "/messages/inbox",
+                params={"summary": True, "limit": 1},
+                headers=headers_recipient,
+            )
+        ).json()
+        assert inbox_summary[0]["snippet"] == long_content[:100]
+        assert "content" not in inbox_summary[0]
+        [sent_summary] = (
+            await client.get(
+                "/messages/sent", params={"summary": True, "limit": 1}, headers=headers
+            )
+        ).json()
+        assert sent_summary["id"] == long_resp.json()["id"]
+        assert sent_summary["snippet"] == long_content[:100]
+        assert "content" not in sent_summary
+        assert sent_summary["recipients"][0]["recipient_id"] == recipient["id"]
+        full_resp = await client.get(f"/messages/{sent_summary['id']}", headers=headers)
+        assert full_resp.json()["content"] == long_content
+
+        # Search ranks subject matches above content matches, pages by cursor
+        for payload in (
+            {"subject": "Lunch plans", "content": "Are pelicans welcome?"},
+            {"subject": "Pelican sighting", "content": "Saw a pelican at lunch"},
+        ):
+            await client.post(
+                "/messages",
+                json={**payload, "recipient_ids": [recipient["id"]]},
+                headers=headers,
+            )
+        search_resp = await client.get(
+            "/messages/search",
+            params={"q": "pelican", "limit": 1},
+            headers=headers_recipient,
+        )
+        assert search_resp.status_code == 200
+        first = search_resp.json()
+        assert [m["subject"] for m in first] == ["Pelican sighting"]
+        assert "<b>pelican</b>" in first[0]["snippet"]
+        next_search_resp = await client.get(
+            "/messages/search",
+            params={
+                "q": "pelican",
+                "limit": 1,
+                "cursor": search_resp.headers["X-Next-Cursor"],
+            },
+            headers=headers_recipient,
+        )
+        assert [m["subject"] for m in next_search_resp.json()] == ["Lunch plans"]
+        assert "X-Next-Cursor" not in next_search_resp.headers
+        # the sender finds their sent copy, a third user finds nothing
+        sender_search = await client.get(
+            "/messages/search", params={"q": "pelicans"}, headers=headers
+        )
+        assert len(sender_search.json()) == 2
+        outsider = (
+            await client.post(
+                "/users",
+                json={"email": f"outsider-{uuid4()}@example.com", "name": "Outsider"},
+            )
+        ).json()
+        outsider_search = await client.get(
+            "/messages/search",
+            params={"q": "pelican"},
+            headers={"Authorization": f"Bearer {outsider['token']}"},
+        )
+        assert outsider_search.json() == []
+
+        # Replies join the parent's conversation and move it to the top
+        reply_resp = await client.post(
+            "/messages",
+            json={
+                "content": "Replying to the first message",
+                "recipient_ids": [sender["id"]],
+                "reply_to_id": message_id,
+            },
+            headers=headers_recipient,
+        )
+        assert reply_resp.status_code == 200
+        reply = reply_resp.json()
+        assert reply["conversation_id"] == sent_message["conversation_id"]
+        assert reply["reply_to_id"] == message_id
+
+        conversations_resp = await client.get(
+            "/conversations", params={"limit": 1}, headers=headers
+        )
+        assert conversations_resp.status_code == 200
+        [latest] = conversations_resp.json()
+        assert latest["id"] == reply["conversation_id"]
+        assert latest["last_message"]["id"] == reply["id"]
+        assert sorted(latest["participant_ids"]) == sorted(
+            [sender["id"], recipient["id"]]
+        )
+        assert "X-Next-Cursor" in conversations_resp.headers
+
+        thread_resp = await client.get(
+            f"/conversations/{reply['conversation_id']}/messages", headers=headers
+        )
+        assert [m["id"] for m in thread_resp.json()] == [reply["id"], message_id]
+
+        # outsiders can neither reply into nor read the conversation
+        outsider_headers = {"Authorization": f"Bearer {outsider['token']}"}
+        outsider_reply = await client.post(
+            "/messages",
+            json={
+                "content": "Let me in",
+                "recipient_ids": [sender["id"]],
+                "reply_to_id": message_id,
+            },
+            headers=outsider_headers,
+        )
+        assert outsider_reply.status_code == 404
+        outsider_thread = await client.get(
+            f"/conversations/{reply['conversation_id']}/messages",
+            headers=outsider_headers,
+        )
+        assert outsider_thread.status_code == 404
+
+        # Metrics are labelled by route template and count DB work per request,
+        # statements that fail included
+        duplicate_resp = await client.post(
+            "/users", json={"email": "sender@example.com", "name": "Sender"}
+        )
+        assert duplicate_resp.status_code == 400
+        metrics_resp = await client.get("/metrics")
+        assert metrics_resp.status_code == 200
+        assert metrics_resp.headers["content-type"].startswith("text/plain")
+        metrics = metrics_resp.text
+        assert (
+            'http_requests_total{method="GET",route="/messages/inbox",status="200"}'
+            in metrics
+        )
+        assert 'route="/messages/{message_id}"' in metrics
+        assert 'route="' + message_id not in metrics
+        assert 'db_queries_per_request_bucket{route="/messages",le="0"} 0' in metrics
+        assert "message_fanout_recipients_count" in metrics
+        assert "\ndb_statement_errors_total " in metrics
+        assert 'db_pool_checkouts_total{pool="primary"}' in metrics
+
+
+# same loop as test_message_flow: pooled connections are bound to the loop
+# that opened them
+@pytest.mark.asyncio(loop_scope="module")
+async def test_bulk_send_is_copied_in_the_send_transaction(monkeypatch):
+    # any send with more than one recipient takes the COPY path
+    monkeypatch.setattr(service, "BULK_SEND_THRESHOLD", 1)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        sender, *recipients = [
+            (
+                await client.post(
+                    "/users",
+                    json={"email": f"bulk-{uuid4()}@example.com", "name": "Bulk"},
+                )
+            ).json()
+            for _ in range(4)
+        ]
+        headers = {"Authorization": f"Bearer {sender['token']}"}
+        send_resp = await client.post(
+            "/messages",
+            json={
+                "subject": "Bulk",
+                "content": "To everyone",
+                "recipient_ids": [r["id"] for r in recipients],
+            },
+            headers=headers,
+        )
+        assert send_resp.status_code == 200
+        message_id = send_resp.json()["id"]
+
+        for recipient in recipients:
+            recipient_headers = {"Authorization": f"Bearer {recipient['token']}"}
+            inbox = (
+                await client.get("/messages/inbox", headers=recipient_headers)
+            ).json()
+            assert [m["subject"] for m in inbox] == ["Bulk"]
+            assert inbox[0]["read"] is False
+            count = await client.get(
+                "/messages/unread/count", headers=recipient_headers
+            )
+            assert count.json()["unread_count"] == 1
+            conversations = (
+                await client.get("/conversations", headers=recipient_headers)
+            ).json()
+            assert [c["last_message"]["id"] for c in conversations] == [message_id]
+
+        # the first recipient reads it; the counter and the sender's receipt
+        # follow the copied row
+        first_headers = {"Authorization": f"Bearer {recipients[0]['token']}"}
+        inbox = (await client.get("/messages/inbox", headers=first_headers)).json()
+        read_resp = await client.put(
+            f"/message-recipients/{inbox[0]['id']}/read", headers=first_headers
+        )
+        assert read_resp.status_code == 200
+        assert read_resp.json()["read"] is True
+        count = await client.get("/messages/unread/count", headers=first_headers)
+        assert count.json()["unread_count"] == 0
+        sent = (await client.get(f"/messages/{message_id}", headers=headers)).json()
+        status = {r["recipient_id"]: r["read"] for r in sent["recipients"]}
+        assert status == {
+            recipients[0]["id"]: True,
+            recipients[1]["id"]: False,
+            recipients[2]["id"]: False,
+        }
+
+        # a send that fails after the COPY leaves nothing behind, and isn't
+        # counted in the fan-out histogram
+        async def sends_counted():
+            metrics = (await client.get("/metrics")).text
+            return next(
+                line
+                for line in metrics.splitlines()
+                if line.startswith("message_fanout_recipients_count ")
+            )
+
+        counted = await sends_counted()
+
+        async def fail(*args):
+            raise RuntimeError("touch_conversation failed")
+
+        monkeypatch.setattr(service, "touch_conversation", fail)
+        with pytest.raises(RuntimeError):
+            await client.post(
+                "/messages",
+                json={
+                    "subject": "Lost",
+                    "content": "Never delivered",
+                    "recipient_ids": [r["id"] for r in recipients],
+                },
+                headers=headers,
+            )
+        for recipient in recipients:
+            recipient_headers = {"Authorization": f"Bearer {recipient['token']}"}
+            inbox = (
+                await client.get("/messages/inbox", headers=recipient_headers)
+            ).json()
+            assert [m["subject"] for m in inbox] == ["Bulk"]
+        assert await sends_counted() == counted
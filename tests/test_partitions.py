@@ -0,0 +1,45 @@
+# Test monthly partition creation for messages and message_recipients
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import engine
+from app.partitions import add_months, create_partitions, month_start
+
+
+def test_month_arithmetic_rolls_over_years():
+    month = month_start(datetime(2026, 11, 30, 23, 59))
+    assert month == datetime(2026, 11, 1)
+    assert add_months(month, 2) == datetime(2027, 1, 1)
+    assert add_months(month, -11) == datetime(2025, 12, 1)
+
+
+@pytest.mark.asyncio
+async def test_create_partitions_creates_missing_months_once():
+    # DDL is transactional, the rollback drops the partitions again
+    async with AsyncSession(engine) as db:
+        created = await create_partitions(
+            db, datetime(2001, 12, 15), datetime(2002, 1, 1)
+        )
+        assert created == [
+            "messages_p2001_12",
+            "message_recipients_p2001_12",
+            "messages_p2002_01",
+            "message_recipients_p2002_01",
+        ]
+        assert (
+            await create_partitions(db, datetime(2001, 12, 1), datetime(2002, 1, 31))
+            == []
+        )
+        bounds = await db.execute(
+            text(
+                "SELECT pg_get_expr(relpartbound, oid) FROM pg_class "
+                "WHERE relname = 'message_recipients_p2002_01'"
+            )
+        )
+        assert bounds.scalar() == (
+            "FOR VALUES FROM ('2002-01-01 00:00:00') TO ('2002-02-01 00:00:00')"
+        )
+        await db.rollback()
@@ -0,0 +1,444 @@
+# Query-plan regression tests for the service layer
+#
+# Opt-in (PLAN_TESTS=1): seeds a dataset big enough for the planner to
+# prefer indexes, runs each service call, captures the SQL it issues and
+# replays every statement under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)
+# inside a rolled-back transaction. The access paths and buffer count of each
+# statement are compared with the golden files in tests/plans/. A test fails
+# when a plan reaches a table differently, scans messages or message_recipients
+# sequentially, or touches more than PLAN_BUFFER_TOLERANCE times its golden
+# buffers. Re-record the goldens with UPDATE_PLAN_GOLDENS=1 after an
+# intended change and review the diff.
+import json
+import os
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from uuid import UUID
+
+import pytest
+from sqlalchemy import delete, event, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import copy_records, engine
+from app.models import Conversation, Message, User
+from app.partitions import create_partitions
+from app.schemas import MarkReadRequest, MessageCreate, UserCreate
+from app.service import (SNIPPET_LENGTH, check_recipients, check_user,
+                         export_messages_service, get_a_messages_service,
+                         get_all_users, get_conversation_messages_service,
+                         get_conversations_service, get_inbox_messages_service,
+                         get_mailbox_version, get_sent_messages_service,
+                         get_unread_count_service,
+                         get_unread_messages_current_user_service,
+                         get_unread_messages_service, get_user,
+                         mark_message_as_read_service,
+                         mark_messages_as_read_service,
+                         search_messages_service, send_message, users_by_email,
+                         users_by_id)
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv("PLAN_TESTS"), reason="set PLAN_TESTS=1 to check query plans"
+)
+
+GOLDEN_DIR = Path(__file__).with_name("plans")
+UPDATE_GOLDENS = bool(os.getenv("UPDATE_PLAN_GOLDENS"))
+BUFFER_TOLERANCE = float(os.getenv("PLAN_BUFFER_TOLERANCE", "2"))
+NO_SEQ_SCAN = {"messages", "message_recipients"}
+EMAIL_PREFIX = "plan-"
+USERS = 1000
+MESSAGES = 100000
+MAILBOX = 300
+THREAD_LENGTH = 10
+PAGE_SIZE = 50
+# heap layout differs between a fresh and a re-seeded database, which can
+# cost up to a page per returned row without any change in plan
+BUFFER_SLACK = PAGE_SIZE
+# message bodies are drawn from this vocabulary so searches have matches
+WORDS = (
+    "meeting lunch report budget deadline invoice pelican holiday review "
+    "launch draft schedule travel contract release feedback agenda office"
+).split()
+
+
+async def seed() -> SimpleNamespace:
+    """Background traffic plus one reader and one sender with full mailboxes."""
+    rng = random.Random(7)
+
+    def uuid4():
+        return UUID(int=rng.getrandbits(128), version=4)
+
+    now = datetime.utcnow()
+    user_ids = [uuid4() for _ in range(USERS)]
+    reader_id, sender_id = user_ids[0], user_ids[1]
+    messages, recipients, conversations = [], [], {}
+    # (conversation, user) -> newest (timestamp, message) they take part in
+    participants = {}
+    unread_counts = Counter()
+    unread_row_id = None
+    for i in range(MESSAGES):
+        message_id = uuid4()
+        # the first MAILBOX messages go from the sender to the reader
+        from_sender = i < MAILBOX
+        author = sender_id if from_sender else rng.choice(user_ids[2:])
+        timestamp = now - timedelta(minutes=i)
+        content = " ".join(rng.choices(WORDS, k=15))
+        # the mailbox forms threads of THREAD_LENGTH, the rest stand alone
+        if from_sender and i % THREAD_LENGTH:
+            conversation_id = messages[i - i % THREAD_LENGTH][1]
+        else:
+            conversation_id = conversations[message_id] = message_id
+        messages.append(
+            (
+                message_id,
+                conversation_id,
+                author,
+                f"Subject {i}",
+                content,
+                content[:SNIPPET_LENGTH],
+                timestamp,
+            )
+        )
+        targets = rng.sample(user_ids[2:], rng.randint(1, 5))
+        if from_sender:
+            targets.append(reader_id)
+        for user_id in {author, *targets}:
+            participants.setdefault((conversation_id, user_id), (message_id, timestamp))
+        for recipient_id in targets:
+            row_id = uuid4()
+            read = rng.random() < 0.7 and not (from_sender and i % 3 == 0)
+            recipients.append((row_id, message_id, timestamp, recipient_id, read))
+            if not read:
+                unread_counts[recipient_id] += 1
+                if recipient_id == reader_id:
+                    unread_row_id = row_id
+
+    async with AsyncSession(engine) as db:
+        # conversations outlive their messages, clear them before the users
+        await db.execute(
+            delete(Conversation).where(
+                Conversation.id.in_(
+                    select(Message.conversation_id)
+                    .join(User, User.id == Message.sender_id)
+                    .where(User.email.like(f"{EMAIL_PREFIX}%"))
+                )
+            )
+        )
+        await db.execute(delete(User).where(User.email.like(f"{EMAIL_PREFIX}%")))
+        await create_partitions(db, now - timedelta(minutes=MESSAGES), now)
+        await copy_records(
+            db,
+            "users",
+            ["id", "email", "name", "created_at"],
+            [
+                (user_id, f"{EMAIL_PREFIX}{user_id}@example.com", "Plan", now)
+                for user_id in user_ids
+            ],
+        )
+        await copy_records(
+            db,
+            "conversations",
+            ["id", "created_at"],
+            [
+                (message[0], message[-1])
+                for message in messages
+                if message[0] in conversations
+            ],
+        )
+        await copy_records(
+            db,
+            "messages",
+            [
+                "id",
+                "conversation_id",
+                "sender_id",
+                "subject",
+                "content",
+                "snippet",
+                "timestamp",
+            ],
+            messages,
+        )
+        await copy_records(
+            db,
+            "message_recipients",
+            ["id", "message_id", "message_timestamp", "recipient_id", "read"],
+            recipients,
+        )
+        await copy_records(
+            db,
+            "conversation_participants",
+            ["conversation_id", "user_id", "last_message_id", "last_message_at"],
+            [
+                (conversation_id, user_id, message_id, timestamp)
+                for (conversation_id, user_id), (
+                    message_id,
+                    timestamp,
+                ) in participants.items()
+            ],
+        )
+        await copy_records(
+            db,
+            "mailbox_counters",
+            ["user_id", "unread_count"],
+            list(unread_counts.items()),
+        )
+        await db.commit()
+
+    # fresh statistics and visibility map, as autovacuum would leave them. The
+    # sample covers every row so the statistics, and with them the plans, are
+    # the same on every run.
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("SET default_statistics_target = 2000"))
+        await conn.execute(
+            text(
+                "VACUUM ANALYZE users, conversations, messages, message_recipients, "
+                "mailbox_counters, conversation_participants"
+            )
+        )
+        await conn.execute(text("RESET default_statistics_target"))
+
+    return SimpleNamespace(
+        reader_id=reader_id,
+        reader_email=f"{EMAIL_PREFIX}{reader_id}@example.com",
+        sender_id=sender_id,
+        others=user_ids[2:7],
+        message_id=messages[0][0],
+        conversation_id=messages[0][1],
+        unread_row_id=unread_row_id,
+    )
+
+
+async def _consume(stream):
+    async for _ in stream:
+        pass
+
+
+async def _second_inbox_page(db, ids):
+    _, cursor = await get_inbox_messages_service(db, ids.reader_id, PAGE_SIZE)
+    await get_inbox_messages_service(db, ids.reader_id, PAGE_SIZE, cursor)
+
+
+SCENARIOS = {
+    "check_user": lambda db, ids: check_user(
+        db, UserCreate(email=ids.reader_email, name="Plan")
+    ),
+    "get_user": lambda db, ids: get_user(db, ids.reader_id),
+    "get_all_users": lambda db, ids: get_all_users(db, PAGE_SIZE),
+    "check_recipients": lambda db, ids: check_recipients(db, ids.others),
+    "send_message": lambda db, ids: send_message(
+        db,
+        ids.sender_id,
+        MessageCreate(content="Plan", recipient_ids=[ids.reader_id, *ids.others]),
+    ),
+    "mark_message_as_read": lambda db, ids: mark_message_as_read_service(
+        db, ids.unread_row_id, ids.reader_id
+    ),
+    "mark_messages_as_read": lambda db, ids: mark_messages_as_read_service(
+        db, MarkReadRequest(sender_id=ids.sender_id), ids.reader_id
+    ),
+    "unread_count": lambda db, ids: get_unread_count_service(db, ids.reader_id),
+    "mailbox_version": lambda db, ids: get_mailbox_version(db, ids.reader_id),
+    "inbox": lambda db, ids: get_inbox_messages_service(db, ids.reader_id, PAGE_SIZE),
+    "inbox_next_page": _second_inbox_page,
+    "unread": lambda db, ids: get_unread_messages_current_user_service(
+        db, ids.reader_id, PAGE_SIZE
+    ),
+    "unread_one_user": lambda db, ids: get_unread_messages_service(
+        db, ids.reader_id, PAGE_SIZE
+    ),
+    "reply": lambda db, ids: send_message(
+        db,
+        ids.reader_id,
+        MessageCreate(
+            content="Plan", recipient_ids=[ids.sender_id], reply_to_id=ids.message_id
+        ),
+    ),
+    "conversations": lambda db, ids: get_conversations_service(
+        db, ids.reader_id, PAGE_SIZE
+    ),
+    "conversation_messages": lambda db, ids: get_conversation_messages_service(
+        db, ids.conversation_id, ids.reader_id, PAGE_SIZE
+    ),
+    "search": lambda db, ids: search_messages_service(
+        db, ids.reader_id, "pelican budget", PAGE_SIZE
+    ),
+    "sent": lambda db, ids: get_sent_messages_service(db, ids.sender_id, PAGE_SIZE),
+    "message": lambda db, ids: get_a_messages_service(
+        db, ids.message_id, ids.reader_id
+    ),
+    "export_inbox": lambda db, ids: _consume(
+        export_messages_service(ids.reader_id, "inbox", None)
+    ),
+    "export_sent": lambda db, ids: _consume(
+        export_messages_service(ids.sender_id, "sent", None)
+    ),
+}
+
+
+async def capture(scenario, ids) -> list[tuple]:
+    """Run a scenario in a rolled-back transaction and return its statements."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if not many and statement.lstrip().split(None, 1)[0].upper() in (
+            "SELECT",
+            "INSERT",
+            "UPDATE",
+            "DELETE",
+            "WITH",
+        ):
+            statements.append((statement, parameters))
+
+    users_by_id.clear()
+    users_by_email.clear()
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        async with engine.connect() as conn:
+            transaction = await conn.begin()
+            # the service's commits become savepoints of this transaction
+            db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint")
+            try:
+                await scenario(db, ids)
+            finally:
+                await db.close()
+                await transaction.rollback()
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+async def explain(statements: list[tuple]) -> list[dict]:
+    """Replay statements in order in one rolled-back transaction, as later
+    ones may depend on rows written by earlier ones."""
+    plans = []
+    async with engine.connect() as conn:
+        transaction = await conn.begin()
+        try:
+            for statement, parameters in statements:
+                result = await conn.exec_driver_sql(
+                    f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters
+                )
+                plans.append(result.scalar()[0]["Plan"])
+        finally:
+            await transaction.rollback()
+    return plans
+
+
+async def partition_parents() -> dict[str, str]:
+    """Partitioned table and index of each partition and partition index."""
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            text(
+                "SELECT child.relname, parent.relname FROM pg_inherits "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent"
+            )
+        )
+        return dict(result.all())
+
+
+def fingerprint(node: dict, parents: dict[str, str]) -> list[str]:
+    """How each table is reached, e.g. "messages using messages_pkey".
+
+    Join order and join method, and plain versus bitmap index scans, flip
+    with small changes in statistics or heap layout. They are left out so
+    that only losing or switching an index shows up as a change. Partitions
+    are named by their parent: which months a query touches depends on the
+    date the test runs.
+    """
+    return sorted(
+        {
+            " ".join(parents.get(word, word) for word in path.split(" "))
+            for path in _access_paths(node, None)
+        }
+    )
+
+
+# the planner reads the empty partitions of coming months sequentially, which
+# costs nothing; only sequential scans that read rows count
+def _empty_seq_scan(node: dict) -> bool:
+    return node["Node Type"] == "Seq Scan" and not (
+        node.get("Actual Rows") or node.get("Rows Removed by Filter")
+    )
+
+
+def _access_paths(node: dict, relation: str | None) -> list[str]:
+    relation = node.get("Relation Name", relation)
+    if _empty_seq_scan(node):
+        return []
+    if node["Node Type"] == "Seq Scan":
+        return [f"{relation} seq scan"]
+    if "Index Name" in node:
+        return [f"{relation} using {node['Index Name']}"]
+    paths = []
+    for child in node.get("Plans", []):
+        # bitmap index scans name only the index, pass the heap scan's table
+        # down to them, through any BitmapAnd / BitmapOr in between
+        paths += _access_paths(
+            child, relation if node["Node Type"].startswith("Bitmap") else None
+        )
+    return paths
+
+
+def seq_scans(node: dict, parents: dict[str, str]) -> list[str]:
+    found = []
+    relation = parents.get(node.get("Relation Name"), node.get("Relation Name"))
+    if (
+        node["Node Type"] == "Seq Scan"
+        and relation in NO_SEQ_SCAN
+        and not _empty_seq_scan(node)
+    ):
+        found.append(node["Relation Name"])
+    for child in node.get("Plans", []):
+        found += seq_scans(child, parents)
+    return found
+
+
+@pytest.mark.asyncio
+async def test_service_query_plans():
+    ids = await seed()
+    parents = await partition_parents()
+    failures = []
+    for name, scenario in SCENARIOS.items():
+        plans = []
+        statements = await capture(scenario, ids)
+        for (statement, _), plan in zip(statements, await explain(statements)):
+            plans.append(
+                {
+                    "statement": statement,
+                    "fingerprint": fingerprint(plan, parents),
+                    "buffers": plan.get("Shared Hit Blocks", 0)
+                    + plan.get("Shared Read Blocks", 0),
+                }
+            )
+            for relation in seq_scans(plan, parents):
+                failures.append(f"{name}: sequential scan on {relation}")
+
+        golden_path = GOLDEN_DIR / f"{name}.json"
+        if UPDATE_GOLDENS:
+            GOLDEN_DIR.mkdir(exist_ok=True)
+            golden_path.write_text(json.dumps(plans, indent=2) + "\n")
+            continue
+        if not golden_path.exists():
+            failures.append(f"{name}: no golden, run with UPDATE_PLAN_GOLDENS=1")
+            continue
+        golden = json.loads(golden_path.read_text())
+        if [p["fingerprint"] for p in plans] != [p["fingerprint"] for p in golden]:
+            failures.append(
+                f"{name}: plan changed\n"
+                + json.dumps([p["fingerprint"] for p in plans], indent=2)
+            )
+            continue
+        for i, (plan, expected) in enumerate(zip(plans, golden)):
+            allowed = expected["buffers"] * BUFFER_TOLERANCE + BUFFER_SLACK
+            if plan["buffers"] > allowed:
+                failures.append(
+                    f"{name}[{i}]: {plan['buffers']} buffers, golden "
+                    f"{expected['buffers']}"
+                )
+
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,109 @@
+# Test real-time delivery of new messages
+import asyncio
+import json
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+from httpx import ASGITransport, AsyncClient
+from starlette.websockets import WebSocketDisconnect
+
+from app.main import app
+from app.realtime import _deliver_notification, hub, notify_payload, sse_events
+
+
+def test_websocket_receives_new_message():
+    with TestClient(app) as client:
+        sender = client.post(
+            "/users", json={"email": f"ws-sender-{uuid4()}@example.com", "name": "S"}
+        ).json()
+        recipient = client.post(
+            "/users", json={"email": f"ws-recipient-{uuid4()}@example.com", "name": "R"}
+        ).json()
+
+        with client.websocket_connect(
+            f"/messages/stream?token={recipient['token']}"
+        ) as websocket:
+            send_resp = client.post(
+                "/messages",
+                json={
+                    "subject": "Live",
+                    "content": "Hi",
+                    "recipient_ids": [recipient["id"]],
+                },
+                headers={"Authorization": f"Bearer {sender['token']}"},
+            )
+            assert send_resp.status_code == 200
+            event = websocket.receive_json()
+
+        assert event["message_id"] == send_resp.json()["id"]
+        assert event["sender_id"] == sender["id"]
+        assert event["subject"] == "Live"
+        assert event["read"] is False
+
+        inbox = client.get(
+            "/messages/inbox",
+            headers={"Authorization": f"Bearer {recipient['token']}"},
+        ).json()
+        assert inbox[0]["id"] == event["id"]
+
+
+def test_websocket_rejects_invalid_token():
+    with TestClient(app) as client:
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect("/messages/stream?token=bad") as websocket:
+                websocket.receive_text()
+
+
+def test_sse_events_format_published_events():
+    async def scenario():
+        events = sse_events("user-1")
+        assert await anext(events) == ": connected\n\n"
+        next_event = asyncio.ensure_future(anext(events))
+        await asyncio.sleep(0)
+        hub.publish("user-1", '{"id": "1"}')
+        assert await next_event == 'event: message\ndata: {"id": "1"}\n\n'
+        await events.aclose()
+        assert "user-1" not in hub.connected()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.asyncio
+async def test_notification_reaches_connected_recipients_only():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        sender, online, offline = [
+            (
+                await client.post(
+                    "/users",
+                    json={
+                        "email": f"notify-{name}-{uuid4()}@example.com",
+                        "name": name,
+                    },
+                )
+            ).json()
+            for name in ("sender", "online", "offline")
+        ]
+        send_resp = await client.post(
+            "/messages",
+            json={
+                "content": "From another worker",
+                "recipient_ids": [online["id"], offline["id"]],
+            },
+            headers={"Authorization": f"Bearer {sender['token']}"},
+        )
+        message = send_resp.json()
+
+    # as relayed from another worker's NOTIFY
+    queue = hub.subscribe(online["id"])
+    try:
+        await _deliver_notification(
+            notify_payload(message["id"], datetime.fromisoformat(message["timestamp"]))
+        )
+        event = json.loads(queue.get_nowait())
+        assert event["message_id"] == message["id"]
+        assert queue.empty()
+    finally:
+        hub.unsubscribe(online["id"], queue)
@@ -0,0 +1,90 @@
+# Test read-replica routing with read-your-writes stickiness
+#
+# Needs a second, unreplicated Postgres with the schema migrated (see
+# `just test-replica`): anything read from it is visibly missing the rows
+# written to the primary, which shows where each read was routed.
+import asyncio
+import os
+from uuid import uuid4
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app.db import DB_STICKY_SECONDS, STICKY_COOKIE
+from app.main import app
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv("DB_REPLICA_URLS"), reason="DB_REPLICA_URLS is not set"
+)
+
+
+@pytest.mark.asyncio
+async def test_reads_go_to_replica_except_right_after_a_write():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        sender = (
+            await client.post(
+                "/users", json={"email": f"replica-{uuid4()}@example.com", "name": "S"}
+            )
+        ).json()
+        recipient = (
+            await client.post(
+                "/users", json={"email": f"replica-{uuid4()}@example.com", "name": "R"}
+            )
+        ).json()
+        headers = {"Authorization": f"Bearer {sender['token']}"}
+        # a user just created is read back from the primary
+        created_resp = await client.get(f"/users/{recipient['id']}")
+        assert created_resp.status_code == 200
+        # creating the users counts as a write, let that window pass first
+        await asyncio.sleep(DB_STICKY_SECONDS + 0.1)
+        send_resp = await client.post(
+            "/messages",
+            json={"content": "Hello", "recipient_ids": [recipient["id"]]},
+            headers=headers,
+        )
+        assert send_resp.status_code == 200
+
+        # the sender just wrote, so their reads stay on the primary
+        sent = (await client.get("/messages/sent", headers=headers)).json()
+        assert [m["id"] for m in sent] == [send_resp.json()["id"]]
+
+        # the stickiness is carried by the cookie, not by this worker's memory
+        cookie = send_resp.cookies[STICKY_COOKIE]
+        async with AsyncClient(
+            transport=transport, base_url="http://test", cookies={STICKY_COOKIE: cookie}
+        ) as other:
+            sent = (await other.get("/messages/sent", headers=headers)).json()
+            assert [m["id"] for m in sent] == [send_resp.json()["id"]]
+        # a cookie whose signature doesn't match is ignored
+        forged = cookie.rsplit(":", 1)[0] + ":" + "0" * 64
+        async with AsyncClient(
+            transport=transport, base_url="http://test", cookies={STICKY_COOKIE: forged}
+        ) as other:
+            assert (await other.get("/messages/sent", headers=headers)).json() == []
+
+        # the recipient has not written, their inbox is read from the replica
+        inbox_resp = await client.get(
+            "/messages/inbox",
+            headers={"Authorization": f"Bearer {recipient['token']}"},
+        )
+        assert inbox_resp.json() == []
+
+        # once the stickiness window has passed the sender reads the replica too
+        await asyncio.sleep(DB_STICKY_SECONDS + 0.1)
+        assert (await client.get("/messages/sent", headers=headers)).json() == []
+
+        # marking messages read pins the reader to the primary, but only when
+        # something was marked
+        recipient_headers = {"Authorization": f"Bearer {recipient['token']}"}
+        mark = {"sender_id": sender["id"]}
+        marked = await client.put(
+            "/message-recipients/read", json=mark, headers=recipient_headers
+        )
+        assert len(marked.json()) == 1
+        assert STICKY_COOKIE in marked.cookies
+        remarked = await client.put(
+            "/message-recipients/read", json=mark, headers=recipient_headers
+        )
+        assert remarked.json() == []
+        assert STICKY_COOKIE not in remarked.cookies
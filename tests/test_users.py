@@ -4,6 +4,8 @@ from httpx import ASGITransport, AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
+from app import dependencies
+from app.dependencies import load_revoked_tokens
 from app.main import app
 
 
@@ -26,12 +28,33 @@ async def test_user_api_flow():
         users = get_all_resp.json()
         assert any(u["id"] == user_id for u in users)
 
+        # 2b. Search and page the directory
+        search_resp = await client.get("/users", params={"q": "KHANHPRO@"})
+        assert search_resp.status_code == 200
+        assert [u["id"] for u in search_resp.json()] == [user_id]
+        no_match_resp = await client.get("/users", params={"q": "no_such%user"})
+        assert no_match_resp.status_code == 200
+        assert no_match_resp.json() == []
+        page_resp = await client.get("/users", params={"limit": 1})
+        assert len(page_resp.json()) == 1
+
         # 3. Get single user
         get_user_resp = await client.get(f"/users/{user_id}")
         assert get_user_resp.status_code == 200
         user_data = get_user_resp.json()
         assert user_data["email"] == "khanhpro@gmail.com"
 
+        # Repeated lookups are served from the user cache
+        hits = (await client.get("/stats")).json()["user_cache"]["by_id"]["hits"]
+        assert (await client.get(f"/users/{user_id}")).json() == user_data
+        stats = (await client.get("/stats")).json()
+        assert stats["user_cache"]["by_id"]["hits"] == hits + 1
+        assert stats["pool"]["checkouts"] > 0
+        assert (
+            stats["pool"]["checked_out"]
+            <= stats["pool"]["size"] + stats["pool"]["max_overflow"]
+        )
+
         # 4. Login user
         login_resp = await client.post(
             "/auths/login", json={"email": "khanhpro@gmail.com", "name": "Khanh"}
@@ -39,3 +62,24 @@ async def test_user_api_flow():
         assert login_resp.status_code == 200
         token_data = login_resp.json()
         assert "token" in token_data
+
+        # 5. Logout revokes the token
+        headers = {"Authorization": f"Bearer {token_data['token']}"}
+        assert (await client.get("/messages/inbox", headers=headers)).status_code == 200
+        logout_resp = await client.post("/auths/logout", headers=headers)
+        assert logout_resp.status_code == 204
+        revoked_resp = await client.get("/messages/inbox", headers=headers)
+        assert revoked_resp.status_code == 401
+
+        # 6. The revocation is persisted: a worker starting afresh loads it
+        dependencies.revoked_tokens.clear()
+        dependencies.token_cache.clear()
+        await load_revoked_tokens()
+        reloaded_resp = await client.get("/messages/inbox", headers=headers)
+        assert reloaded_resp.status_code == 401
+
+        # 7. Logging out with a token that doesn't verify is rejected
+        invalid_resp = await client.post(
+            "/auths/logout", headers={"Authorization": "Bearer not-a-token"}
+        )
+        assert invalid_resp.status_code == 401